@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Check that a dump is sorted in byte order (the order of 'sort' with LC_ALL=C), and find split points.
+
+The file is memory-mapped and cut into chunks at line boundaries. Every chunk is checked by a separate
+process, then the last key of each chunk is compared with the first key of the next one. Chunk boundaries
+are returned as evenly spaced split points (<offset>, <first key>), which can be used to partition later
+processing of the file.
+"""
+import os
+import sys
+import json
+import mmap
+import argparse
+
+from multiprocessing import Pool
+
+
+def line_key(line, separator=None):
+    "Return the sort key of the line: the line itself, or its first field if separator is given."
+    line = line.rstrip(b'\n')
+    if separator is not None:
+        line = line.split(separator, 1)[0]
+    return line
+
+
+def chunk_offsets(path, nchunks):
+    """
+    Split the file into (at most) nchunks parts of about the same size, at line boundaries.
+
+    @return: list of offsets, starting with 0 and ending with the file size
+    """
+    size = os.path.getsize(path)
+    offsets = [0]
+    if size == 0:
+        return offsets
+    with open(path, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(1, nchunks):
+            pos = mm.find(b'\n', max(size * i // nchunks, offsets[-1]))
+            if pos < 0 or pos + 1 >= size:
+                break
+            if pos + 1 > offsets[-1]:
+                offsets.append(pos + 1)
+    offsets.append(size)
+    return offsets
+
+
+def check_chunk(task):
+    """
+    Check order of lines between two offsets.
+
+    @param task: tuple (<path>, <start offset>, <end offset>, <separator as bytes or None>)
+    @return:     tuple (<first key>, <last key>, <offset of the first line out of order or None>)
+    """
+    path, start, end, separator = task
+    first = last = None
+    bad = None
+    with open(path, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        mm.seek(start)
+        pos = start
+        while pos < end:
+            key = line_key(mm.readline(), separator)
+            if first is None:
+                first = key
+            elif key < last:
+                bad = pos
+                break
+            last = key
+            pos = mm.tell()
+    return first, last, bad
+
+
+def check_sorted(path, nprocs=1, separator=None, nsplits=None):
+    """
+    Check whether the file is sorted in byte order.
+
+    @param path:      file to check
+    @param nprocs:    number of processes to use
+    @param separator: if given, only the part of every line before the separator is compared
+    @param nsplits:   number of parts to split the file into. Default is nprocs
+    @return:          dict {'sorted': <bool>, 'error_offset': <offset of the first line out of order or None>,
+                            'splits': [[<offset>, <first key>], ...]}
+    """
+    if isinstance(separator, str):
+        separator = separator.encode()
+    offsets = chunk_offsets(path, nsplits or nprocs)
+    tasks = [(path, offsets[i], offsets[i+1], separator) for i in range(len(offsets) - 1)]
+    if nprocs > 1 and len(tasks) > 1:
+        with Pool(min(nprocs, len(tasks))) as pool:
+            results = pool.map(check_chunk, tasks)
+    else:
+        results = [check_chunk(task) for task in tasks]
+
+    error = None
+    for i, (first, last, bad) in enumerate(results):
+        if bad is not None:
+            error = bad
+            break
+        if i > 0 and first is not None and results[i-1][1] is not None and first < results[i-1][1]:
+            error = offsets[i]
+            break
+    splits = [[offsets[i], results[i][0].decode(errors='replace')] for i in range(len(results)) if results[i][0] is not None]
+    return {'sorted': error is None, 'error_offset': error, 'splits': splits}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', '--nprocs', help="Number of processes to use. Default is the number of CPUs.", type=int, default=os.cpu_count())
+    parser.add_argument('-k', '--separator', help="Compare only the part of every line before this separator.", default=None)
+    parser.add_argument('-p', '--parts', help="Number of split points to produce. Default is the number of processes.", type=int, default=None)
+    parser.add_argument('-o', '--output', help="Write the result, including split points, to this file as JSON.", default=None)
+    parser.add_argument('path', help="File to check.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    res = check_sorted(args.path, args.nprocs, args.separator, args.parts)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(res, fd)
+    if not res['sorted']:
+        print("File {0} is not sorted, first line out of order is at offset {1}".format(args.path, res['error_offset']), file=sys.stderr)
+        sys.exit(1)
@@ -1,10 +1,27 @@
 #!/usr/bin/env python3
 import argparse
+import heapq
+import json
 import sys
 import os
 
+from shutil import disk_usage
 from subprocess import call
 from contextlib import contextmanager
+from check_sorted import check_sorted
+
+# Rados object names are '<file name>.<object number as 16 hex digits>', see search_stub.filename2object
+OBJECT_SUFFIX_LEN = 17
+# Greater than the name of any object of a file (files with 2**60 objects and more do not exist)
+LAST_OBJECT_SUFFIX = '.0' + 'f' * 15
+
+DEF_MEMORY_BUDGET = 2048
+# Estimated peak memory needed to compare a dump in memory, per byte of the dump
+MEMORY_FACTOR = 1
+# Estimated disk space needed to sort a dump (temporary files of 'sort' and the sorted copy), per byte of the dump
+SORT_SPACE_FACTOR = 2
+# Number of distinct keys sorted at once when a dump is loaded into memory
+LOAD_CHUNK = 100000
 
 def sort_file(filename, tmpdir, ncpus=None):
     if not os.path.exists(tmpdir):
@@ -12,16 +29,316 @@ def sort_file(filename, tmpdir, ncpus=None):
     output = tmpdir + '/' + os.path.basename(filename) + '_sorted'
     extra = [] if ncpus is None else ["--parallel", ncpus]
     call(
-            ["/usr/bin/sort", "-k", "1", "-t", "|", "-T", tmpdir, "-o", output] + extra + [filename],
-            env={'LC_COLLATE': 'utf-8'}
+            ["/usr/bin/sort", "-k", "1,1", "-t", "|", "-T", tmpdir, "-o", output] + extra + [filename],
+            env={'LC_ALL': 'C'}
         )
     return output
 
+def read_manifest(path):
+    """
+    If the file is a manifest of sorted runs (as written by find_leaves.py --runs), return paths of the runs.
+    Otherwise return None.
+    """
+    with open(path) as fd:
+        if fd.read(1) != '{':
+            return None
+        fd.seek(0)
+        try:
+            manifest = json.load(fd)
+        except ValueError:
+            return None
+    if not isinstance(manifest, dict) or 'runs' not in manifest:
+        return None
+    return [os.path.join(os.path.dirname(path), run) for run in manifest['runs']]
+
+
+class MergedRuns:
+    """
+    File-like object reading several sorted runs as one sorted file. Only readline and close are supported.
+    """
+    def __init__(self, paths):
+        self.FDs = [open(path) for path in paths]
+        self.lines = heapq.merge(*self.FDs)
+
+    def readline(self):
+        return next(self.lines, '')
+
+    def close(self):
+        for fd in self.FDs:
+            fd.close()
+
+
+class ObjectDump:
+    """
+    File-like object reading a sorted dump of rados objects as a sorted list of file names.
+    Only readline and close are supported.
+
+    Order of object names differs from the order of file names: objects of the file 'a' come after
+    the objects of the file 'a-b', because '-' < '.'. So file names are kept in a heap until the dump
+    reaches the point after which no smaller file name can appear.
+
+    @param path:            path to the dump
+    @param count_separator: if not None, number of objects is appended to file name after this separator
+    """
+    def __init__(self, path, count_separator=None):
+        self.fd = open(path)
+        self.count_separator = count_separator
+        self.heap = []
+        self.counts = {}
+        self.release = {}
+        self.last_obj = ''
+        self.eof = False
+
+    @staticmethod
+    def release_key(name):
+        """
+        Return object name such that, once the dump goes past it, no file name smaller than the given one can appear.
+        These are the names of the last objects of the file itself and of the files whose names are the prefixes
+        of the given name followed by a character that is not greater than '.'.
+        """
+        keys = [name[:i] + LAST_OBJECT_SUFFIX for i in range(1, len(name)) if name[i] <= '.']
+        keys.append(name + LAST_OBJECT_SUFFIX)
+        return max(keys)
+
+    def _read_object(self):
+        line = self.fd.readline()
+        if line == '':
+            self.eof = True
+            return
+        self.last_obj = line.rstrip('\n')
+        name = self.last_obj[:-OBJECT_SUFFIX_LEN]
+        if name in self.counts:
+            self.counts[name] += 1
+        else:
+            self.counts[name] = 1
+            self.release[name] = self.release_key(name)
+            heapq.heappush(self.heap, name)
+
+    def readline(self):
+        while self.heap or not self.eof:
+            if self.heap and (self.eof or self.last_obj > self.release[self.heap[0]]):
+                name = heapq.heappop(self.heap)
+                count = self.counts.pop(name)
+                del self.release[name]
+                if self.count_separator is not None:
+                    return '{0}{1}{2}\n'.format(name, self.count_separator, count)
+                return name + '\n'
+            self._read_object()
+        return ''
+
+    def close(self):
+        self.fd.close()
+
+
+def encode_varint(value, data):
+    "Append unsigned integer to bytearray, 7 bits per byte."
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+
+
+def decode_varint(data, pos):
+    "Read unsigned integer written by encode_varint, return it and the position after it."
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def common_prefix_len(a, b):
+    """
+    Length of the common prefix of two byte strings. Strings are read as little-endian integers,
+    so the lowest set bit of their XOR falls into the first byte that differs.
+    """
+    diff = int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')
+    res = ((diff & -diff).bit_length() - 1) >> 3 if diff else len(a)
+    return min(res, len(a), len(b))
+
+
+class FrontCodedKeys:
+    """
+    Sorted keys stored in one bytearray using front coding: every key is written as the length of the prefix
+    it shares with the previous key, the length of the remaining part and the remaining part itself.
+    LFNs share long directory prefixes, so this takes several times less memory than a list of str.
+    Both lengths are varints, for keys shorter than 128 bytes each of them takes one byte.
+    Keys can only be read sequentially, by iterating over the instance.
+
+    @param keys: sorted iterable of unique keys, as bytes
+    """
+    def __init__(self, keys):
+        data = bytearray()
+        count = 0
+        prev = b''
+        for key in keys:
+            shared = common_prefix_len(prev, key)
+            rest = len(key) - shared
+            if rest < 0x80 and shared < 0x80:
+                data.append(shared)
+                data.append(rest)
+            else:
+                encode_varint(shared, data)
+                encode_varint(rest, data)
+            data += key[shared:]
+            prev = key
+            count += 1
+        self.data = data
+        self.count = count
+
+    def __iter__(self):
+        data = self.data
+        pos = 0
+        key = b''
+        for _ in range(self.count):
+            shared = data[pos]
+            if shared < 0x80:
+                pos += 1
+            else:
+                shared, pos = decode_varint(data, pos)
+            size = data[pos]
+            if size < 0x80:
+                pos += 1
+            else:
+                size, pos = decode_varint(data, pos)
+            key = key[:shared] + data[pos:pos + size]
+            pos += size
+            yield key
+
+
+class KeyRuns:
+    """
+    Keys of a dump loaded into memory, kept as several sorted FrontCodedKeys runs and merged while they are read.
+    Keys present in several runs are returned once.
+
+    @param runs:            list of FrontCodedKeys instances
+    @param count_separator: if not None, keys of the runs are stored as <key>\\0<count>, and they are returned
+                            as <key><count_separator><sum of counts>
+    """
+    def __init__(self, runs, count_separator=None):
+        self.runs = runs
+        self.count_separator = count_separator
+
+    def __iter__(self):
+        keys = heapq.merge(*self.runs) if len(self.runs) > 1 else iter(self.runs[0])
+        if self.count_separator is not None:
+            separator = self.count_separator.encode()
+            pairs = merge_counts((key, int(count)) for key, count in (item.rsplit(b'\0', 1) for item in keys))
+            for key, count in pairs:
+                yield key + separator + str(count).encode()
+        elif len(self.runs) > 1:
+            prev = None
+            for key in keys:
+                if key != prev:
+                    yield key
+                    prev = key
+        else:
+            yield from keys
+
+    def open(self):
+        return LineReader(key.decode() + '\n' for key in self)
+
+
+class LineReader:
+    """
+    File-like object returning lines produced by an iterator. Only readline and close are supported.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+
+    def readline(self):
+        return next(self.lines, '')
+
+    def close(self):
+        pass
+
+
+def merge_counts(pairs):
+    "Merge sorted (<key>, <count>) pairs, summing counts of equal keys."
+    prev, total = None, 0
+    for key, count in pairs:
+        if key == prev:
+            total += count
+            continue
+        if prev is not None:
+            yield prev, total
+        prev, total = key, count
+    if prev is not None:
+        yield prev, total
+
+
+def load_keys(path, prefix='', separator=None, dump_type=None, chunk_size=LOAD_CHUNK):
+    """
+    Read keys of the dump (unsorted) into memory, the same way compare_sorted extracts them.
+    Duplicate keys are merged. For the 'objc' dump type number of objects is appended to every key after the separator.
+
+    At most chunk_size keys are kept uncompressed: every chunk is sorted and front-coded into a separate run,
+    and the runs are merged only when the keys are read. So the peak memory is about one compressed copy
+    of the keys plus one chunk, not the whole dump as Python objects.
+
+    @return: KeyRuns instance
+    """
+    counted = dump_type == 'objc'
+
+    def flush(chunk):
+        if counted:
+            # b'\0' sorts before any character of a key, so the order of keys is preserved
+            return FrontCodedKeys(key + b'\0' + str(chunk[key]).encode() for key in sorted(chunk))
+        return FrontCodedKeys(sorted(chunk))
+
+    runs = []
+    chunk = {} if counted else set()
+    prefix = prefix.encode()
+    prefix_len = len(prefix)
+    split = separator.encode() if separator is not None and dump_type is None else None
+    with open(path, 'rb') as fd:
+        for line in fd:
+            line = line.strip()
+            if dump_type is not None:
+                line = line[:-OBJECT_SUFFIX_LEN]
+            if line.startswith(prefix):
+                line = line[prefix_len:]
+                if split is not None:
+                    line = line.split(split, 1)[0]
+                if counted:
+                    chunk[line] = chunk.get(line, 0) + 1
+                else:
+                    chunk.add(line)
+                if len(chunk) >= chunk_size:
+                    runs.append(flush(chunk))
+                    chunk.clear()
+    if chunk or not runs:
+        runs.append(flush(chunk))
+    return KeyRuns(runs, separator if counted else None)
+
+
+def open_dump(path, dump_type=None, separator=None, keys=None):
+    """
+    Open dump for reading.
+
+    @param path:      path to the dump or to the manifest of sorted runs
+    @param dump_type: None for the list of files, 'obj' for the dump of rados objects,
+                      'objc' for the dump of rados objects with object counts appended after the separator
+    @param separator: dump separator
+    @param keys:      KeyRuns instance, if the dump is loaded into memory
+    """
+    if keys is not None:
+        return keys.open()
+    if dump_type in ('obj', 'objc'):
+        return ObjectDump(path, separator if dump_type == 'objc' else None)
+    runs = read_manifest(path)
+    return open(path) if runs is None else MergedRuns(runs)
+
+
 @contextmanager
-def open_files(path_array):
+def open_files(path_array, types=None, separators=None, keys=None):
     FDs = []
-    for path in path_array:
-        fd = open(path)
+    for i, path in enumerate(path_array):
+        fd = open_dump(path, types[i] if types else None, separators[i] if separators else None, keys[i] if keys else None)
         FDs.append(fd)
     try:
         yield FDs
@@ -34,33 +351,41 @@ def compare_sorted(files_data):
     files = [d['path'] for d in files_data]
     separators = [d['separator'] for d in files_data]
     prefixes = [(d['prefix'], len(d['prefix'])) for d in files_data]
-    with open_files(files) as FDs:
+    types = [d.get('type') for d in files_data]
+    keys = [d.get('keys') for d in files_data]
+    with open_files(files, types, separators, keys) as FDs:
         lines = [None for _ in range(len(FDs))]
         eof = False
         min_line = None
         rest_diff = False
         old_rest = None
+        counts = [None for _ in range(len(FDs))]
         while not eof:
             eof = True
             for i, fd in enumerate(FDs):
                 if min_line == chr(255):
                     break
                 if lines[i] == min_line:
-                    line = fd.readline()
-                    if line != '':
-                        eof = False
-                        line = line.strip()
-                        if line.startswith(prefixes[i][0]):
-                            line = line[prefixes[i][1]:]
-                            if separators[i] is not None:
-                                line, rest = line.split(separators[i], maxsplit=1)
-                            if old_rest:
-                                rest_diff = rest == old_rest
-                                old_rest = rest
+                    line = min_line
+                    # Repeated keys are skipped, so that duplicates are not reported as missing in other dumps
+                    while line == min_line:
+                        line = fd.readline()
+                        if line != '':
+                            eof = False
+                            line = line.strip()
+                            if line.startswith(prefixes[i][0]):
+                                line = line[prefixes[i][1]:]
+                                if separators[i] is not None:
+                                    line, rest = line.split(separators[i], maxsplit=1)
+                                    if types[i] == 'objc':
+                                        counts[i] = int(rest)
+                                if old_rest:
+                                    rest_diff = rest == old_rest
+                                    old_rest = rest
+                            else:
+                                line = chr(255) if min_line is not None else None
                         else:
-                            line = chr(255) if min_line is not None else None
-                    else:
-                        line = chr(255)
+                            line = chr(255)
                     lines[i] = line
 
             min_line = min(lines) if None not in lines else None
@@ -71,15 +396,56 @@ def compare_sorted(files_data):
                         miss_data.append(files[i])
 
                 if miss_data:
-                    yield {min_line: miss_data}
+                    res = {min_line: miss_data}
+                    objects = {files[i]: counts[i] for i, line in enumerate(lines) if line == min_line and types[i] == 'objc'}
+                    if objects:
+                        res['objects'] = objects
+                    yield res
 
                 if not miss_data and rest_diff:
                     yield {min_line: 'mismatch'}
 
 
-def compare(dumps, ncpus=None, sorted=False, print_only=None):
+def find_unsorted(dumps, nprocs):
+    """
+    Check that dumps given as sorted are indeed sorted in byte order, comparing only the first field of each line.
+    Manifests of sorted runs are not checked.
+
+    @return: list of paths of unsorted dumps
+    """
+    res = []
+    for dump in dumps:
+        if dump.get('type') is None and read_manifest(dump['path']) is not None:
+            continue
+        separator = dump['separator'] if dump.get('type') is None else None
+        if not check_sorted(dump['path'], nprocs, separator)['sorted']:
+            res.append(dump['path'])
+    return res
+
+
+def choose_engine(paths, tmpdir, ncpus=None, memory_budget=DEF_MEMORY_BUDGET):
+    """
+    Decide whether dumps that need sorting should be compared in memory or sorted on disk.
+
+    Sorting on disk is faster at every dump size (2-3 times for dumps above 1 MB), so memory is used only
+    if there is not enough free space in tmpdir to sort the dumps, they are expected to fit into memory_budget (in MiB)
+    and sort parallelism is not requested.
+    """
+    if ncpus is not None:
+        return 'external'
+    total = sum(os.path.getsize(path) for path in paths)
+    tmpdir = os.path.abspath(tmpdir or '.')
+    while not os.path.exists(tmpdir):
+        tmpdir = os.path.dirname(tmpdir)
+    if disk_usage(tmpdir).free >= total * SORT_SPACE_FACTOR:
+        return 'external'
+    return 'memory' if total * MEMORY_FACTOR <= memory_budget * 1024 * 1024 else 'external'
+
+
+def compare(dumps, ncpus=None, sorted=False, print_only=None, engine='external', memory_budget=DEF_MEMORY_BUDGET):
     if not sorted:
         sorted_dumps = []
+        to_sort = []
         for i, dump in enumerate(dumps):
             try:
                 path, prefix, separator = dump['path'], dump['prefix'], dump['separator']
@@ -87,7 +453,21 @@ def compare(dumps, ncpus=None, sorted=False, print_only=None):
                 path = dump
                 prefix = ''
                 separator = None
-            sorted_dumps.append({ 'path': sort_file(path, args.tmpdir, ncpus), 'prefix': prefix, 'separator': separator})
+            dump_type = dump.get('type') if isinstance(dump, dict) else None
+            sorted_dumps.append({ 'path': path, 'prefix': prefix, 'separator': separator, 'type': dump_type})
+            if dump_type is not None or read_manifest(path) is None:
+                to_sort.append(sorted_dumps[-1])
+        if engine == 'auto':
+            engine = choose_engine([d['path'] for d in to_sort], args.tmpdir, ncpus, memory_budget)
+        for dump in to_sort:
+            if engine == 'memory':
+                dump['keys'] = load_keys(dump['path'], dump['prefix'], dump['separator'], dump['type'])
+                if dump['type'] == 'objc':
+                    dump['prefix'] = ''
+                else:
+                    dump.update({'prefix': '', 'separator': None, 'type': None})
+            else:
+                dump['path'] = sort_file(dump['path'], args.tmpdir, ncpus)
     else:
         sorted_dumps = dumps
     for res in compare_sorted(sorted_dumps):
@@ -95,39 +475,62 @@ def compare(dumps, ncpus=None, sorted=False, print_only=None):
             print(res)
         else:
             should_print = True
-            vals = [x for x in res.values()][0]
+            key = next(iter(res))
+            vals = res[key]
             if len(vals) == len(print_only):
                 for idx in print_only:
                     if sorted_dumps[idx]['path'] not in vals:
                         should_print = False
                         break
                 if should_print:
-                    for k in res:
-                        print(k)
+                    print(key)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-d', '--dumps', help="Dump list to be compared, comma-separated.", type=str)
+    parser.add_argument('-d', '--dumps', help="Dump list to be compared, comma-separated. Every dump is given as path[%%prefix%%separator[%%type]]. " \
+            + "A manifest of sorted runs written by find_leaves.py can be given instead of a dump, it is never re-sorted. " \
+            + "Type 'obj' means that the dump lists rados objects, they are collapsed into file names (the separator is ignored). " \
+            + "Type 'objc' does the same and reports number of objects of the files missing in other dumps.", type=str)
     parser.add_argument('-t', '--tmpdir', help="Temporary directory.", type=str)
     parser.add_argument('-o', '--print_only', help="Print file only if it is missing in dumps indicated here. Comma-separated list of idxes, starging from zero.", type=str, default=None)
+    parser.add_argument('-e', '--engine', help="How to sort dumps: 'external' (default) sorts them on disk into <dump>_sorted files, " \
+            + "'memory' compares them in memory without writing sorted files (slower, but needs no disk space), " \
+            + "'auto' uses memory only if there is not enough space in the temporary directory to sort dumps, " \
+            + "dumps fit into the memory budget and --ncpus is not given.", choices=['auto', 'memory', 'external'], default='external')
+    parser.add_argument('-m', '--memory', help="Memory budget for in-memory comparison, MiB. Default is {0}.".format(DEF_MEMORY_BUDGET), type=int, default=DEF_MEMORY_BUDGET)
     g = parser.add_mutually_exclusive_group()
     g.add_argument('-n', '--ncpus', help="Number of cpus to use when sorting.", type=str, default=None)
-    g.add_argument('-s', '--sorted', help="Assume that dumps are already sorted. Note that order should be according to UTF-8 encoding (LC_COLLATE='utf-8').", action='store_true')
+    g.add_argument('-s', '--sorted', help="Assume that dumps are already sorted. Note that order should be byte order of the first field (LC_ALL=C sort -t'|' -k1,1).", action='store_true')
+    parser.add_argument('-c', '--check_procs', help="Number of processes used to check that dumps given with -s are sorted, 0 disables the check. Default is the number of CPUs.", type=int, default=os.cpu_count())
     args = parser.parse_args()
     dumps = args.dumps.split(',')
     dump_data = []
-    for dump in dumps: 
+    for dump in dumps:
+        dump_type = None
         try:
-            path, prefix, separator= dump.split('%')
+            path, prefix, separator = dump.split('%')
         except ValueError:
-            path = dump
-            prefix = ''
+            try:
+                path, prefix, separator, dump_type = dump.split('%')
+            except ValueError:
+                path = dump
+                prefix = ''
+                separator = '|'
+        if dump_type == 'objc' and separator == '':
             separator = '|'
+        elif dump_type == 'obj':
+            # Objects are collapsed into bare file names, there is nothing to split
+            separator = None
         if separator == '':
             separator = None
-        dump_data.append({'path': path, 'prefix': prefix, 'separator': separator})
+        dump_data.append({'path': path, 'prefix': prefix, 'separator': separator, 'type': dump_type or None})
+    if args.sorted and args.check_procs > 0:
+        unsorted = find_unsorted(dump_data, args.check_procs)
+        if unsorted:
+            print("Dumps are not sorted: {0}".format(', '.join(unsorted)), file=sys.stderr)
+            sys.exit(1)
     print_only = None
     if args.print_only:
         print_only = [int(x) for x in args.print_only.split(',')]
-    compare(dump_data, args.ncpus, sorted=args.sorted, print_only=print_only)
+    compare(dump_data, args.ncpus, sorted=args.sorted, print_only=print_only, engine=args.engine, memory_budget=args.memory)
@@ -6,21 +6,213 @@ Find list of LFNs stored on a given DIRAC SE.
 
 import sys
 import os
+import json
+import sqlite3
 import DIRAC
 from DIRAC.Core.Base import Script
 from DIRAC.Core.Utilities.List import breakListIntoChunks
 from DIRAC import gLogger
 
+from queue import Queue
+from threading import Thread, Lock
 from multiprocessing.pool import ThreadPool
-from multiprocessing import Manager
-from random import shuffle
 
 
-class dummyContextManager:
-    def __enter__(self):
-        return None
-    def __exit__(self, *args):
-        pass
+REPLICA_CHUNK = 1000
+RUN_SIZE = 1000000
+BLOCK_SIZE = 10000
+
+# Query templates built from the catalog metadata schema, {(<catalog id>, <SE>): <query dict>}
+metaQueryCache = {}
+metaQueryLock = Lock()
+
+
+class OutputWriter( Thread ):
+  """
+  Single thread writing LFNs that other threads pass to it through a queue.
+
+  By default LFNs are written to stdout in blocks of blockSize lines. If runDir is given, LFNs are
+  collected into runs of runSize lines instead. Each run is sorted in byte order and written to a separate
+  file in runDir, and the list of runs is saved to <runDir>/manifest.json, which compare_v2.py accepts
+  in place of a sorted dump.
+  """
+  def __init__( self, runDir=None, runSize=RUN_SIZE, blockSize=BLOCK_SIZE, out=None ):
+    Thread.__init__( self )
+    self.runDir = runDir
+    self.runSize = runSize
+    self.blockSize = blockSize
+    self.out = sys.stdout if out is None else out
+    self.queue = Queue()
+    self.runs = []
+    self.buffer = []
+
+  def write( self, lfns ):
+    "Pass a batch of LFNs to the writer."
+    self.queue.put( list(lfns) )
+
+  def run( self ):
+    while True:
+      lfns = self.queue.get()
+      if lfns is None:
+        break
+      self.buffer += lfns
+      if len(self.buffer) >= (self.runSize if self.runDir else self.blockSize):
+        self.flush()
+    self.flush()
+    if self.runDir:
+      with open( os.path.join(self.runDir, 'manifest.json'), 'w' ) as fd:
+        json.dump( {'order': 'bytes', 'runs': self.runs}, fd )
+
+  def flush( self ):
+    if not self.buffer:
+      return
+    if self.runDir:
+      name = 'run_%06d' % len(self.runs)
+      with open( os.path.join(self.runDir, name), 'wb' ) as fd:
+        fd.write( b''.join( lfn + b'\n' for lfn in sorted( lfn.encode() for lfn in self.buffer ) ) )
+      self.runs.append(name)
+    else:
+      self.out.write( ''.join( lfn + '\n' for lfn in self.buffer ) )
+      self.out.flush()
+    self.buffer = []
+
+  def close( self ):
+    "Write everything that is left and stop the writer."
+    self.queue.put(None)
+    self.join()
+
+
+class DirectorySnapshot:
+  """
+  Local sqlite snapshot of the previous dump, used to skip subtrees that did not change.
+
+  For every visited directory the snapshot keeps its signature and the LFNs found in it: either by
+  findFilesByMetadata (already known to be on the SE) or by ls (replicas still have to be resolved).
+  The signature is built from getDirectorySize, which the catalog maintains for the whole subtree,
+  so a directory with unchanged signature can be skipped together with everything below it.
+
+  Signatures of directories are saved only in close(), and only for subtrees without failures,
+  so an interrupted or partially failed run never makes incomplete data look up to date.
+  Whenever LFNs of a directory are rewritten, stored signatures of all its parents are reset.
+
+  The snapshot is only valid for the SE, root directory and exclude list it was built with. If any of them
+  differs from the stored one, the snapshot is emptied.
+  """
+  def __init__( self, path, se=None, root=None, exclude=None ):
+    self.path = path
+    self.conn = sqlite3.connect( path, check_same_thread=False )
+    self.lock = Lock()
+    self.pending = {}
+    self.conn.execute( "CREATE TABLE IF NOT EXISTS dirs (name TEXT PRIMARY KEY, parent TEXT, signature TEXT)" )
+    self.conn.execute( "CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)" )
+    self.conn.execute( "CREATE TABLE IF NOT EXISTS lfns (node TEXT, lfn TEXT, resolved INTEGER)" )
+    self.conn.execute( "CREATE INDEX IF NOT EXISTS lfns_node ON lfns (node)" )
+    self.conn.execute( "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)" )
+    self.conn.commit()
+    self._checkParameters( { 'se': se, 'root': root, 'exclude': sorted(exclude or []) } )
+
+  def _checkParameters( self, params ):
+    "Empty the snapshot if it was built with other parameters. Changes are committed only in close()."
+    stored = dict( self.conn.execute( "SELECT key, value FROM meta" ) )
+    params = { key: json.dumps(value) for key, value in params.items() }
+    if stored != params:
+      if stored:
+        print( "Snapshot {0} was made with different parameters, it will not be used".format(self.path), file=sys.stderr )
+      self.conn.execute( "DELETE FROM dirs" )
+      self.conn.execute( "DELETE FROM lfns" )
+      self.conn.execute( "DELETE FROM meta" )
+      self.conn.executemany( "INSERT INTO meta (key, value) VALUES (?, ?)", params.items() )
+
+  @staticmethod
+  def getSignature( fc, directory, se ):
+    "Return signature of the subtree or None if it can not be obtained."
+    res = fc.getDirectorySize( directory, True )
+    if not res['OK'] or directory not in res['Value']['Successful']:
+      return None
+    size = res['Value']['Successful'][directory]
+    onSE = size.get('PhysicalSize', {}).get(se, {})
+    return '%s:%s:%s' % ( size.get('LogicalFiles'), onSE.get('Files', 0), onSE.get('Size', 0) )
+
+  def isUnchanged( self, directory, signature ):
+    """
+    Check whether the directory had the same signature during the previous run. Remembers the new one,
+    if the signature is None the stored one is reset in close().
+    """
+    with self.lock:
+      self.pending[directory] = signature
+      if signature is None:
+        return False
+      row = self.conn.execute( "SELECT signature FROM dirs WHERE name = ?", (directory,) ).fetchone()
+    return row is not None and row[0] == signature
+
+  def reuse( self, directory, writer ):
+    """
+    Pass LFNs on the SE stored for the directory and all its subdirectories to the writer, in blocks of BLOCK_SIZE.
+
+    Rows are read through a separate connection, so other threads can use the snapshot meanwhile. Data stored
+    in the previous run is visible to it, and this run never rewrites a subtree that is reused.
+
+    @return: list of ls-found LFNs of the subtree, their replicas still have to be resolved
+    """
+    lsfiles = []
+    conn = sqlite3.connect( self.path )
+    try:
+      rows = conn.execute( "SELECT lfn, resolved FROM lfns WHERE node = ? OR (node > ? AND node < ?)",
+                           (directory, directory + '/', directory + '0') )
+      while True:
+        block = rows.fetchmany( BLOCK_SIZE )
+        if not block:
+          break
+        writer.write( [lfn for lfn, resolved in block if resolved] )
+        lsfiles.extend( lfn for lfn, resolved in block if not resolved )
+    finally:
+      conn.close()
+    return lsfiles
+
+  def _setNode( self, directory, lfns, resolved ):
+    self.conn.execute( "INSERT OR IGNORE INTO dirs (name, parent) VALUES (?, ?)", (directory, os.path.dirname(directory)) )
+    parents = []
+    name = directory
+    while os.path.dirname(name) != name:
+      name = os.path.dirname(name)
+      parents.append(name)
+    self.conn.executemany( "UPDATE dirs SET signature = NULL WHERE name = ?", ((name,) for name in parents) )
+    self.conn.execute( "DELETE FROM lfns WHERE node = ?", (directory,) )
+    self.conn.executemany( "INSERT INTO lfns (node, lfn, resolved) VALUES (?, ?, ?)", ((directory, lfn, resolved) for lfn in lfns) )
+
+  def _dropSubdirs( self, directory, keep=() ):
+    stored = [row[0] for row in self.conn.execute( "SELECT name FROM dirs WHERE parent = ?", (directory,) )]
+    for name in set(stored) - set(keep):
+      for table, column in (('dirs', 'name'), ('lfns', 'node')):
+        self.conn.execute( "DELETE FROM %s WHERE %s = ? OR (%s > ? AND %s < ?)" % (table, column, column, column),
+                           (name, name + '/', name + '0') )
+
+  def storeListing( self, directory, subdirs, files ):
+    "Save ls results of the directory, forget subdirectories that are not there any more."
+    with self.lock:
+      self._setNode( directory, files, 0 )
+      self._dropSubdirs( directory, subdirs )
+
+  def storeFound( self, directory, lfns ):
+    "Save LFNs found in the whole subtree by findFilesByMetadata."
+    with self.lock:
+      self._setNode( directory, lfns, 1 )
+      self._dropSubdirs( directory )
+
+  def close( self, failed ):
+    """
+    Save signatures of the directories processed in this run and close the snapshot.
+
+    @param failed: directories that failed. Signatures of these directories and all their parents are reset.
+    """
+    with self.lock:
+      for directory, signature in self.pending.items():
+        prefix = directory.rstrip('/') + '/'
+        if any( d == directory or d.startswith(prefix) for d in failed ):
+          signature = None
+        self.conn.execute( "UPDATE dirs SET signature = ? WHERE name = ?", (signature, directory) )
+      self.conn.commit()
+      self.conn.close()
 
 
 def doLs( directory, fc ):
@@ -31,6 +223,10 @@ def doLs( directory, fc ):
   res = fc.listDirectory(directory, False)
   if not res['OK']:
     gLogger.error( "Can not list directory %s: %s" % (directory, res['Message']) )
+    return None
+  if directory not in res['Value']['Successful']:
+    gLogger.error( "Can not list directory %s: %s" % (directory, res['Value']['Failed'].get(directory)) )
+    return None
 
   subdirs = res['Value']['Successful'][directory]['SubDirs']
   for key in  subdirs:
@@ -45,81 +241,155 @@ def doLs( directory, fc ):
   return (dirs, files)
 
 
-def getDirList( directory, depth, fc, exclude=None ):
-  resd = []
-  resf = []
-
-  if depth == 0:
-    resd.append(directory)
-  elif depth > 0 :
-    (dirs, files) = doLs( directory, fc )
-    resf = resf + files
-    for f in dirs:
-      if exclude is None or f not in exclude:
-        (tdirs, tfiles) = getDirList( f, depth-1, fc, exclude )
-        if tdirs:
-          resd = resd + tdirs
-        else:
-          resd.append(f)
-        resf = resf + tfiles
-  else:
-    gLogger.error("getDirList: depth is less than zero")
-    DIRAC.exit(-1)
-  return ( resd, resf )
-
-
-def findFiles( directory, fc, se, lock ):
+def getMetaQuery( fc, se, refresh=False ):
+  """
+  Return metadata query selecting files on the SE (without the path part).
+
+  The metadata schema is requested from the catalog only on the first call (or if refresh is True),
+  the resulting query is shared by all threads. Every call returns a new copy of it.
+  """
+  key = (id(fc), se)
+  with metaQueryLock:
+    if refresh or key not in metaQueryCache:
+      res = fc.getMetadataFields()
+      if not res['OK']:
+        gLogger.error( 'Can not access File Catalog:', res['Message'] )
+        DIRAC.exit( -1 )
+      typeDict = res['Value']['FileMetaFields']
+      typeDict.update( res['Value']['DirectoryMetaFields'] )
+      # Special meta tags
+      typeDict.update( FILE_STANDARD_METAKEYS )
+
+      mq = MetaQuery( typeDict = typeDict )
+      res = mq.setMetaQuery( [ 'SE=%s' % se ] )
+      if not res['OK']:
+        gLogger.error( "Illegal metaQuery:", res['Message'] )
+        DIRAC.exit( -1 )
+      metaQueryCache[key] = res['Value']
+    return dict( metaQueryCache[key] )
+
+
+def findFiles( directory, fc, se, writer ):
   print("find in {0}".format(directory), file=sys.stderr)
-  res = fc.getMetadataFields()
-  if not res['OK']:
-    gLogger.error( 'Can not access File Catalog:', res['Message'] )
-    DIRAC.exit( -1 )
-  typeDict = res['Value']['FileMetaFields']
-  typeDict.update( res['Value']['DirectoryMetaFields'] )
-  # Special meta tags
-  typeDict.update( FILE_STANDARD_METAKEYS )
+  metaDict = getMetaQuery( fc, se )
 
-  mq = MetaQuery( typeDict = typeDict )
-  res = mq.setMetaQuery( [ 'Path=%s' % directory, 'SE=%s' % se ] )
-  if not res['OK']:
-    gLogger.error( "Illegal metaQuery:", res['Message'] )
-    DIRAC.exit( -1 )
-  metaDict = res['Value']
-  path = metaDict.pop( 'Path', directory )
-
-  res = fc.findFilesByMetadata( metaDict, path )
+  res = fc.findFilesByMetadata( metaDict, directory )
   if not res['OK']:
     gLogger.error( 'Can not find files from directory {0}: {1}'.format(directory, res['Message']) )
     fres = None
   else:
-    with lock:
-      for f in res['Value']:
-        print(f)
-    fres = 1
+    writer.write( res['Value'] )
+    fres = res['Value']
   return fres
 
-def processDirectories( directories, fc, se, lock ):
-    failed = []
-    files = []
-    for dr in directories:
-        res = findFiles(dr, fc, se, lock)
-        if not res:
-          failed.append(dr)
-    return failed
-
-def getFiles( directories, se, lock, attempts=3 ):
-    my_fc = FileCatalog()
-    failed = processDirectories(directories, fc, se, lock)
-    files = []
-    while attempts > 0 and failed:
-      dirs = []
-      for dr in failed:
-        td, tf = getDirList(dr, 1, fc)
-        dirs += td
-        files += tf
-      failed = processDirectories(dirs, fc, se, lock)
-      attempts = attempts - 1
-    return (failed, files)
+def walkWorker( queue, fc, se, writer, exclude, failed, files, snapshot=None ):
+  """
+  Take directories from the queue until None is received.
+
+  Queue items are tuples (<directory>, <depth>, <attempts>, <new>). Directories with positive depth are listed
+  and their subdirectories are put back into the queue with depth decreased by one. Directories with zero
+  depth are searched with findFiles. If the search fails and attempts are left, the directory is split:
+  it is put back with depth 1, so that its subdirectories are searched separately.
+
+  If snapshot is given, every new directory is first checked against it, and if the subtree did not change
+  since the previous run, LFNs stored in the snapshot are used instead of querying the catalog.
+  """
+  while True:
+    item = queue.get()
+    if item is None:
+      queue.task_done()
+      break
+    directory, depth, attempts, new = item
+    try:
+      if snapshot is not None and new and snapshot.isUnchanged( directory, snapshot.getSignature(fc, directory, se) ):
+        files.extend( snapshot.reuse( directory, writer ) )
+      elif depth > 0:
+        res = doLs( directory, fc )
+        if res is None:
+          failed.append(directory)
+        else:
+          dirs, lsfiles = res
+          files.extend(lsfiles)
+          dirs = [d for d in dirs if exclude is None or d not in exclude]
+          if snapshot is not None:
+            snapshot.storeListing( directory, dirs, lsfiles )
+          for d in dirs:
+            queue.put( (d, depth - 1, attempts, True) )
+      else:
+        found = findFiles( directory, fc, se, writer )
+        if found is not None:
+          if snapshot is not None:
+            snapshot.storeFound( directory, found )
+        elif attempts > 0:
+          queue.put( (directory, 1, attempts - 1, False) )
+        else:
+          failed.append(directory)
+    except Exception as exc:
+      gLogger.error( "Failed to process directory %s: %s" % (directory, exc) )
+      failed.append(directory)
+    finally:
+      queue.task_done()
+
+
+def walkTree( directory, fc, se, writer, depth, nthreads=1, exclude=None, attempts=3, snapshot=None ):
+  """
+  Find all files in the directory tree with a pool of threads sharing one work queue.
+
+  The tree is listed down to the given depth, then every directory at that depth is searched with findFiles.
+  Directories are handed to whichever thread is free, and directories that can not be searched in one go
+  are split further, so one large subtree does not keep a single thread busy for the whole run.
+  With a DirectorySnapshot only the subtrees changed since the previous run are queried.
+
+  @return: tuple (<failed directories>, <files found by ls>)
+  """
+  queue = Queue()
+  failed = []
+  files = []
+  threads = [
+      Thread( target=walkWorker, args=(queue, fc, se, writer, exclude, failed, files, snapshot) ) for _ in range(max(1, nthreads))
+    ]
+  for thread in threads:
+    thread.start()
+  queue.put( (directory, depth, attempts, True) )
+  queue.join()
+  for thread in threads:
+    queue.put(None)
+  for thread in threads:
+    thread.join()
+  return (failed, files)
+
+
+def resolveChunk( chunk, fc, se, writer, attempts=3 ):
+  """
+  Resolve replicas of the given LFNs and pass those that have a replica on the SE to the writer.
+
+  @return: None on success, the chunk itself if all attempts failed
+  """
+  for _ in range(attempts):
+    res = fc.getReplicas(chunk)
+    if res['OK']:
+      writer.write( lfn for lfn, se_dict in res['Value']['Successful'].items() if se in se_dict )
+      return None
+    gLogger.error( "Can not resolve replicas of %d files: %s" % (len(chunk), res['Message']) )
+  return chunk
+
+
+def resolveReplicas( files, fc, se, writer, nthreads=1, chunkSize=REPLICA_CHUNK, attempts=3 ):
+  """
+  Output LFNs having a replica on the SE, resolving them in chunks of chunkSize files on a pool of threads.
+  Output is produced as soon as a chunk is resolved, a failed chunk does not affect the others.
+
+  @return: list of LFNs whose replicas could not be resolved
+  """
+  failed = []
+  chunks = breakListIntoChunks(files, chunkSize)
+  pool = ThreadPool(max(1, nthreads))
+  for res in pool.imap_unordered(lambda chunk: resolveChunk(chunk, fc, se, writer, attempts), chunks):
+    if res:
+      failed += res
+  pool.close()
+  pool.join()
+  return failed
 
 
 if __name__ == "__main__":
@@ -129,6 +399,10 @@ if __name__ == "__main__":
   Script.registerSwitch( '', 'depth=', '    depth to be used during directory tree split. 3 by default' )
   Script.registerSwitch( '', 'threads=', '    Number of threads to use for file dumping' )
   Script.registerSwitch( '', 'SE=', '    Dump files only from this storage elements' )
+  Script.registerSwitch( '', 'runs=', '    Write LFNs as sorted runs with a manifest into this directory instead of stdout' )
+  Script.registerSwitch( '', 'runSize=', '    Number of LFNs in one sorted run. %d by default' % RUN_SIZE )
+  Script.registerSwitch( '', 'snapshot=', '    Local file with the snapshot of the previous dump, unchanged directories are taken from it' )
+  Script.registerSwitch( '', 'chunk=', '    Number of ls-found files to resolve replicas for in one call. %d by default' % REPLICA_CHUNK )
   #Script.setUsageMessage( '\n'.join(
   #      [
   #        __doc__.split( '\n' )[1],
@@ -153,6 +427,10 @@ if __name__ == "__main__":
   rfiles = []
   se = 'RAL-RDST'
   nthreads = 3
+  chunkSize = REPLICA_CHUNK
+  runDir = None
+  runSize = RUN_SIZE
+  snapshotPath = None
 
   for opt, val in Script.getUnprocessedSwitches():
     if opt == 'Path':
@@ -165,6 +443,14 @@ if __name__ == "__main__":
       se = val
     elif opt == 'threads':
       nthreads = int(val)
+    elif opt == 'chunk':
+      chunkSize = int(val)
+    elif opt == 'runs':
+      runDir = val
+    elif opt == 'runSize':
+      runSize = int(val)
+    elif opt == 'snapshot':
+      snapshotPath = val
 
   if directory in exclude:
     print("Warning: path in exclude, it will not be excluded", file=sys.stderr)
@@ -179,33 +465,29 @@ if __name__ == "__main__":
     gLogger.error("Path must be a directory, but %s is not" % directory)
     DIRAC.exit( -1 )
 
-  dirs, files = getDirList(directory, depth, fc, exclude)
-  shuffle(dirs)
-  if nthreads > 1:
-    pool = ThreadPool(nthreads)
-    lst_size = len(dirs) // 3 + 1
-    with Manager() as manager:
-      lock = manager.Lock()
-      res = pool.starmap(getFiles, ((x, se, lock) for x in breakListIntoChunks(dirs, lst_size)))
-  else:
-    dummy_lock = dummyContextManager()
-    res = [getFiles(dirs, se, dummy_lock)]
+  if depth < 0:
+    gLogger.error("depth is less than zero")
+    DIRAC.exit(-1)
 
-  failed_dirs = []
-  for d, f in res:
-    files += f
-    failed_dirs += d
+  if runDir and not os.path.isdir(runDir):
+    os.makedirs(runDir)
+  writer = OutputWriter(runDir, runSize)
+  writer.start()
+  snapshot = DirectorySnapshot(snapshotPath, se, directory, exclude) if snapshotPath else None
+  failed_dirs, files = walkTree(directory, fc, se, writer, depth, nthreads, exclude, snapshot=snapshot)
+  if snapshot is not None:
+    snapshot.close(failed_dirs)
 
   print("Now process ls-found replicas", file=sys.stderr)
-  resolved_replicas = fc.getReplicas(files)
-  if not resolved_replicas['OK']:
-    print("Failed to resolve ls-found replicas", file=sys.stderr)
-  else:
-    for lfn, se_dict in resolved_replicas['Value']['Successful'].items():
-      if se in se_dict:
-        print(lfn)
+  failed_files = resolveReplicas(files, fc, se, writer, nthreads, chunkSize)
+  writer.close()
 
   if failed_dirs:
     print("\n\n\nFAILED DIRS:")
     for d in failed_dirs:
       print(d)
+
+  if failed_files:
+    print("\n\n\nFAILED REPLICA LOOKUPS:")
+    for f in failed_files:
+      print(f)
@@ -2,12 +2,22 @@
 
 import os
 import sys
+import json
+import time
 import rados
+import pstats
+import cProfile
 import argparse
+import sqlite3
+import threading
+import tracemalloc
 
 from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
+from random import random
 from subprocess import run, PIPE
 from tempfile import mkstemp
+from check_sorted import check_sorted
 
 DEF_NTHREADS = 1
 DEF_NPROCS = 1
@@ -15,11 +25,259 @@ DEF_TMPDIR = '/tmp'
 
 FLUSH_STEP = 1000
 
+DEF_LATENCY_FACTOR = 2.0
+DEF_BASELINE_DECAY = 0.1
+
+DEF_STATS_INTERVAL = 60
+PROFILE_TOP = 30
+
 def filename2object(filename, obj_num):
     "Given file's name and object number, get full object's name"
     return '{0}.{1:0>16x}'.format(filename, obj_num)
 
 
+class AdaptiveLimiter:
+    """
+    Limit the number of rados operations in flight using AIMD (additive increase, multiplicative decrease).
+
+    The limit starts at min_inflight. After every window of operations (window size equals the current limit)
+    that completed without errors and with the average latency not exceeding latency_factor times the baseline
+    latency, the limit is increased by one, up to max_inflight. On a rados error or a slow window the limit
+    is halved, but not below min_inflight. Optionally the rate of operations is capped by max_rate operations
+    per second.
+
+    The baseline follows window averages of windows without errors: a faster window replaces it at once,
+    a slower one moves it up by baseline_decay of the difference. So neither a short burst of unusually fast
+    operations nor a lasting change of the cluster latency keeps the limit at min_inflight for the rest of the run.
+
+    If min_inflight equals max_inflight and max_rate is None, the limiter just keeps the concurrency fixed.
+    """
+    def __init__(self, min_inflight=1, max_inflight=1, max_rate=None, latency_factor=DEF_LATENCY_FACTOR,
+            baseline_decay=DEF_BASELINE_DECAY):
+        self.min_inflight = max(1, min_inflight)
+        self.max_inflight = max(self.min_inflight, max_inflight)
+        self.max_rate = max_rate
+        self.latency_factor = latency_factor
+        self.baseline_decay = baseline_decay
+        self.limit = self.min_inflight
+        self.inflight = 0
+        self._cond = threading.Condition()
+        self._next_slot = 0.0
+        self._baseline_latency = None
+        self._window_ops = 0
+        self._window_latency = 0.0
+        self._window_errors = 0
+
+    def acquire(self):
+        """
+        Wait until a new operation is allowed to start.
+
+        @return: start time of the operation, to be passed to release
+        """
+        delay = 0
+        with self._cond:
+            while self.inflight >= self.limit:
+                self._cond.wait()
+            self.inflight += 1
+            if self.max_rate:
+                now = time.monotonic()
+                delay = self._next_slot - now
+                self._next_slot = max(now, self._next_slot) + 1.0 / self.max_rate
+        if delay > 0:
+            time.sleep(delay)
+        return time.monotonic()
+
+    def release(self, start, failed=False):
+        """
+        Register completion of the operation and adjust the limit.
+
+        @param start:  value returned by acquire
+        @param failed: True if the operation failed because of the cluster (not because of missing data)
+        """
+        latency = time.monotonic() - start
+        with self._cond:
+            self.inflight -= 1
+            self._window_ops += 1
+            self._window_latency += latency
+            if failed:
+                self._window_errors += 1
+            if self._window_ops >= self.limit:
+                self._adjust()
+            self._cond.notify_all()
+
+    def _adjust(self):
+        "Close current window and change the limit accordingly. Must be called with the lock held."
+        avg_latency = self._window_latency / self._window_ops
+        slow = self._baseline_latency is not None and avg_latency > self.latency_factor * self._baseline_latency
+        if self._window_errors or slow:
+            self.limit = max(self.min_inflight, self.limit // 2)
+        elif self.limit < self.max_inflight:
+            self.limit += 1
+        if not self._window_errors:
+            if self._baseline_latency is None or avg_latency < self._baseline_latency:
+                self._baseline_latency = avg_latency
+            else:
+                self._baseline_latency += self.baseline_decay * (avg_latency - self._baseline_latency)
+        self._window_ops = 0
+        self._window_latency = 0.0
+        self._window_errors = 0
+
+
+class Stats:
+    """
+    Run-time statistics of stub search: latency histograms and error counts of rados operations, time spent
+    on dump parsing and waiting for results, queue depth, and number of processed files.
+
+    Latency histograms have power-of-two buckets; a bucket is named after its upper bound in microseconds.
+    find_stub uses timers 'dump_loop' (the pass over the dump), 'wait' (waiting for results of the thread pool) and
+    'check' (checks done without the thread pool), so dump parsing takes roughly dump_loop - wait - check.
+    If path is given, statistics are written there as JSON every interval seconds (after start() is called)
+    and on stop(). Otherwise stop() prints them to stderr.
+    """
+    def __init__(self, path=None, interval=DEF_STATS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.limiter = None
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._ops = {}
+        self._counters = {}
+        self._timers = {}
+        self._queue_depth = 0
+        self._max_queue_depth = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, op, latency, error=None):
+        """
+        Register completed rados operation.
+
+        @param op:      operation name
+        @param latency: duration of the operation, seconds
+        @param error:   exception raised by the operation, if any
+        """
+        bucket = str(1 << int(latency * 1e6).bit_length())
+        with self._lock:
+            data = self._ops.setdefault(op, {'count': 0, 'total': 0.0, 'histogram_us': {}, 'errors': {}})
+            data['count'] += 1
+            data['total'] += latency
+            data['histogram_us'][bucket] = data['histogram_us'].get(bucket, 0) + 1
+            if error is not None:
+                name = type(error).__name__
+                data['errors'][name] = data['errors'].get(name, 0) + 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_queue_depth(self, depth):
+        with self._lock:
+            self._queue_depth = depth
+            self._max_queue_depth = max(self._max_queue_depth, depth)
+
+    @contextmanager
+    def timer(self, name):
+        "Add time spent inside the with block to the named timer."
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self._timers[name] = self._timers.get(name, 0.0) + elapsed
+
+    def snapshot(self):
+        "Return statistics as a JSON-serializable dict."
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            ops = {}
+            for op, data in self._ops.items():
+                ops[op] = dict(data, mean_ms=1000 * data['total'] / data['count'])
+                ops[op]['histogram_us'] = dict(sorted(data['histogram_us'].items(), key=lambda x: int(x[0])))
+                ops[op]['errors'] = dict(data['errors'])
+            res = {
+                'elapsed': elapsed,
+                'ops': ops,
+                'counters': dict(self._counters),
+                'files_per_s': self._counters.get('files', 0) / elapsed if elapsed > 0 else 0.0,
+                'timers': dict(self._timers),
+                'queue_depth': self._queue_depth,
+                'max_queue_depth': self._max_queue_depth,
+            }
+        if self.limiter is not None:
+            res['limiter'] = {'limit': self.limiter.limit, 'inflight': self.limiter.inflight}
+        return res
+
+    def dump(self):
+        "Write statistics to the file (replacing it) or to stderr."
+        data = json.dumps(self.snapshot(), indent=1)
+        if self.path is None:
+            print(data, file=sys.stderr)
+        else:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as fd:
+                fd.write(data)
+            os.replace(tmp_path, self.path)
+
+    def _report(self):
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+    def start(self):
+        "Start dumping statistics periodically."
+        if self.path is not None:
+            self._thread = threading.Thread(target=self._report, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        "Stop periodic dumps and write final statistics."
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.dump()
+
+
+class LimitedIoctx:
+    """
+    Wrapper around rados ioctx that passes every operation through the AdaptiveLimiter.
+    NoData and ObjectNotFound are treated as normal results, other rados errors reduce the concurrency.
+    If stats is given, latency and errors of every operation are recorded there.
+    """
+    def __init__(self, ctx, limiter, stats=None):
+        self.ctx = ctx
+        self.limiter = limiter
+        self.stats = stats
+        if stats is not None:
+            stats.limiter = limiter
+
+    def _call(self, name, method, *args):
+        start = self.limiter.acquire()
+        failed = False
+        error = None
+        try:
+            return method(*args)
+        except (rados.NoData, rados.ObjectNotFound) as exc:
+            error = exc
+            raise
+        except rados.Error as exc:
+            error = exc
+            failed = True
+            raise
+        finally:
+            self.limiter.release(start, failed)
+            if self.stats is not None:
+                self.stats.record(name, time.monotonic() - start, error)
+
+    def get_xattr(self, key, xattr_name):
+        return self._call('get_xattr', self.ctx.get_xattr, key, xattr_name)
+
+    def stat(self, key):
+        return self._call('stat', self.ctx.stat, key)
+
+    def close(self):
+        self.ctx.close()
+
+
 def simple_check_file(ctx, file_name, obj_count, object_size=None):
     """
     Check whether file is 'stub' or not. Stub means its size according to metadata differs from its real size.
@@ -31,7 +289,22 @@ def simple_check_file(ctx, file_name, obj_count, object_size=None):
     @param obj_count:   number of ceph objects that store file's data
     @param object_size: maximum size of a single ceph object
     """
+    return describe_file(ctx, file_name, obj_count, object_size)[0]
+
+
+def describe_file(ctx, file_name, obj_count, object_size=None):
+    """
+    Do the same check as simple_check_file, but also return the values the verdict is based on.
+
+    @param ctx:         rados context
+    @param file_name:   name of the file to check
+    @param obj_count:   number of ceph objects that store file's data
+    @param object_size: maximum size of a single ceph object
+    @return:            tuple (<verdict>, <striper.size>, <last object size>). Sizes are None if they are unknown
+    """
     res = True
+    size = None
+    last_obj_size = None
     try:
         size = int(ctx.get_xattr(filename2object(file_name, 0), 'striper.size'))
         if object_size is None:
@@ -46,7 +319,53 @@ def simple_check_file(ctx, file_name, obj_count, object_size=None):
         else:
             if object_size * (obj_count-1) + last_obj_size != size:
                 res = False
-    return res
+    return res, size, last_obj_size
+
+
+class ResultCache:
+    """
+    Persistent store of the results of previous stub searches, kept in a sqlite database and keyed by file name.
+
+    For every file the number of objects (taken from the dump), the size of the last object, 'striper.size'
+    and the verdict are stored. A file that was fine last time and still has the same number of objects
+    in the dump need not be checked again. A fraction of such files can still be re-checked by setting sample.
+    Must be used from a single thread.
+    """
+    def __init__(self, path, sample=0.0):
+        self.sample = sample
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, obj_count INTEGER, last_obj_size INTEGER, size INTEGER, ok INTEGER)"
+            )
+        self._pending = 0
+
+    def is_unchanged(self, file_name, obj_count):
+        """
+        Check whether the file can be skipped.
+
+        @param file_name: name of the file
+        @param obj_count: number of file's objects in the current dump
+        @return:          True if file was fine and had the same number of objects during previous check
+        """
+        row = self.conn.execute("SELECT obj_count, ok FROM files WHERE name = ?", (file_name,)).fetchone()
+        if row is None or row[0] != obj_count or not row[1]:
+            return False
+        return not (self.sample and random() < self.sample)
+
+    def store(self, file_name, obj_count, ok, size, last_obj_size):
+        "Save result of the check."
+        self.conn.execute(
+                "INSERT OR REPLACE INTO files (name, obj_count, last_obj_size, size, ok) VALUES (?, ?, ?, ?, ?)",
+                (file_name, obj_count, last_obj_size, size, int(ok))
+            )
+        self._pending += 1
+        if self._pending >= FLUSH_STEP:
+            self.conn.commit()
+            self._pending = 0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
 
 
 def fully_check_file(ctx, file_name):
@@ -105,7 +424,7 @@ def sort_file(filename, tmpdir, ncpus=1):
                 par_opts = ['--parallel', ncpus]
             else:
                 par_opts = []
-            out = run(['sort'] + par_opts + [filename], stdout=fd, env={'LC_COLLATE': 'C'})
+            out = run(['sort'] + par_opts + [filename], stdout=fd, env={'LC_ALL': 'C'})
         if out.returncode != 0:
             print("Failed to sort file {0}:\n{1}\n{2}".format(filename, out.stdout, out.stderr), file=sys.stderr)
             os.unlink(sorted_path)
@@ -113,23 +432,66 @@ def sort_file(filename, tmpdir, ncpus=1):
     return sorted_path
 
 
-def process_results(async_results):
+def report_result(filename, obj_count, result, cache=None, stats=None):
+    """
+    Print the file if it is stub and save the result into the cache.
+
+    @param filename:  name of the file
+    @param obj_count: number of file's objects in the dump
+    @param result:    output of the 'describe_file' function
+    @param cache:     ResultCache instance or None
+    @param stats:     Stats instance or None
+    """
+    ok, size, last_obj_size = result
+    if stats is not None:
+        stats.count('checked')
+    if not ok:
+        print(filename)
+        if stats is not None:
+            stats.count('stub')
+    if cache is not None:
+        cache.store(filename, obj_count, ok, size, last_obj_size)
+
+
+def process_results(async_results, cache=None, stats=None):
     """
     Print stub files that has been already found.
 
-    @param async_results: array [(<file_name>, <async_result>), ...], where <async_result> is the output of async
-                          application of the 'check_file' function to filename
+    @param async_results: array [(<file_name>, <obj_count>, <async_result>), ...], where <async_result> is the output
+                          of async application of the 'describe_file' function to filename
+    @param cache:         ResultCache instance or None
+    @param stats:         Stats instance or None
     """
-    for filename, ares in async_results:
+    for filename, obj_count, ares in async_results:
         ares.wait()
         if not ares.successful():
             print(filename)
+            if stats is not None:
+                stats.count('failed')
         else:
-            if not ares.get():
-                print(filename)
+            report_result(filename, obj_count, ares.get(), cache, stats)
+
+
+def open_limited_ioctx(ceph_pool, conffile, nprocs, min_nprocs=None, max_rate=None, stats=None):
+    """
+    Connect to the cluster and open ioctx with the concurrency limiter attached.
+
+    @param ceph_pool:  ceph pool name
+    @param conffile:   ceph config file
+    @param nprocs:     maximum number of rados operations in flight
+    @param min_nprocs: minimum number of rados operations in flight. If None, concurrency is fixed at nprocs
+    @param max_rate:   maximum number of rados operations per second, None means no limit
+    @param stats:      Stats instance to record operations to
+    @return:           LimitedIoctx instance
+    """
+    cluster = rados.Rados(conffile=conffile)
+    cluster.connect()
+    limiter = AdaptiveLimiter(nprocs if min_nprocs is None else min_nprocs, nprocs, max_rate)
+    return LimitedIoctx(cluster.open_ioctx(ceph_pool), limiter, stats)
 
 
-def find_stub(dump, ceph_pool, object_size=None, nprocs=1, conffile='/etc/ceph/ceph.conf'):
+def find_stub(dump, ceph_pool, object_size=None, nprocs=1, conffile='/etc/ceph/ceph.conf', min_nprocs=None, max_rate=None,
+        cache=None, stats=None):
     """
     Find stub files and print them to stdout. File is considered to be stub if its size differs
     from the 'size' value written in its metadata.
@@ -137,12 +499,16 @@ def find_stub(dump, ceph_pool, object_size=None, nprocs=1, conffile='/etc/ceph/c
     @param dump:        a file with the list of all cehp objects in the pool, separated by newlines
     @param ceph_pool:   ceph pool name
     @param object_size: maximum object size (defined by libradosstriper)
-    @param nprocs:      number of threads to use
+    @param nprocs:      number of threads to use, also the maximum number of rados operations in flight
     @param conffile:    ceph config file
+    @param min_nprocs:  minimum number of rados operations in flight, see AdaptiveLimiter
+    @param max_rate:    maximum number of rados operations per second
+    @param cache:       ResultCache instance. Files that did not change since the previous run are not checked
+    @param stats:       Stats instance to collect run-time statistics
     """
-    cluster = rados.Rados(conffile=conffile)
-    cluster.connect()
-    ctx = cluster.open_ioctx(ceph_pool)
+    if stats is None:
+        stats = Stats()
+    ctx = open_limited_ioctx(ceph_pool, conffile, nprocs, min_nprocs, max_rate, stats)
 
     async_results = []
     last_obj = None
@@ -152,7 +518,7 @@ def find_stub(dump, ceph_pool, object_size=None, nprocs=1, conffile='/etc/ceph/c
     obj_count = 0
     line = None
     idx = 0
-    with open(dump) as fd:
+    with open(dump) as fd, stats.timer('dump_loop'):
         while line != '':
             idx += 1
             if idx % 1000 == 0:
@@ -161,18 +527,24 @@ def find_stub(dump, ceph_pool, object_size=None, nprocs=1, conffile='/etc/ceph/c
             filename = line[:-17]
             last_filename = last_obj[:-17] if last_obj else filename
             if filename != last_filename:
+                stats.count('files')
                 fargs = (ctx, last_filename, obj_count, object_size)
-                if thread_pool:
-                    async_results.append(  ( last_filename, thread_pool.apply_async(check_file, fargs) )  )
+                if cache is None or not cache.is_unchanged(last_filename, obj_count):
+                    if thread_pool:
+                        async_results.append(  ( last_filename, obj_count, thread_pool.apply_async(describe_file, fargs) )  )
+                        stats.set_queue_depth(len(async_results))
+                    else:
+                        with stats.timer('check'):
+                            report_result(last_filename, obj_count, describe_file(*fargs), cache, stats)
                 else:
-                    if not check_file(*fargs):
-                        print(last_filename)
+                    stats.count('skipped')
                 obj_count = 1
             else:
                 obj_count += 1
 
             if len(async_results) > FLUSH_STEP:
-                process_results(async_results)
+                with stats.timer('wait'):
+                    process_results(async_results, cache, stats)
                 async_results = []
 
             last_obj = line
@@ -181,28 +553,45 @@ def find_stub(dump, ceph_pool, object_size=None, nprocs=1, conffile='/etc/ceph/c
     #async_results.append(
     #        (last_filename, thread_pool.apply_async(stat, (ceph_pool, last_obj)), thread_pool.apply_async(stat, (ceph_pool, last_filename, True)))
     #    )
-    process_results(async_results)
+    with stats.timer('wait'):
+        process_results(async_results, cache, stats)
     ctx.close()
 
 
-def verify_stub(file_list, ceph_pool, conffile='/etc/ceph/ceph.conf'):
+def verify_stub(file_list, ceph_pool, conffile='/etc/ceph/ceph.conf', nprocs=1, min_nprocs=None, max_rate=None, stats=None):
     """
     Given the list of potentially stub files, check every file in the list for stubness.
 
-    @param file_list: list of files to check
-    @param ceph_pool: ceph pool where files are supposed to be stored
-    @param conffile:  ceph config file
+    @param file_list:  list of files to check
+    @param ceph_pool:  ceph pool where files are supposed to be stored
+    @param conffile:   ceph config file
+    @param nprocs:     number of threads to use, also the maximum number of rados operations in flight
+    @param min_nprocs: minimum number of rados operations in flight, see AdaptiveLimiter
+    @param max_rate:   maximum number of rados operations per second
+    @param stats:      Stats instance to collect run-time statistics
     """
-    cluster = rados.Rados(conffile=conffile)
-    cluster.connect()
-    ctx = cluster.open_ioctx(ceph_pool)
+    if stats is None:
+        stats = Stats()
+    ctx = open_limited_ioctx(ceph_pool, conffile, nprocs, min_nprocs, max_rate, stats)
+
+    def check(file_name):
+        return file_name, fully_check_file(ctx, file_name)
 
     with open(file_list) as fd:
-        for file_name in fd:
-            file_name = file_name.rstrip()
-            ret = fully_check_file(ctx, file_name)
+        file_names = (file_name.rstrip() for file_name in fd)
+        if nprocs > 1:
+            thread_pool = ThreadPool(nprocs)
+            results = thread_pool.imap(check, file_names)
+        else:
+            thread_pool = None
+            results = map(check, file_names)
+        for file_name, ret in results:
+            stats.count('files')
             if ret > 0:
+                stats.count('stub')
                 print(file_name, ret)
+    if thread_pool:
+        thread_pool.close()
     ctx.close()
 
 
@@ -235,6 +624,38 @@ def find_dark_objects(file_list, object_dump, conffile='/etc/ceph/ceph.conf'):
                         obj = obj.strip()
 
 
+MIN_NTHREADS_HELP = "Minimal number of rados operations in flight. If less than --nthreads, concurrency is adjusted " \
+        + "between the two values according to observed latency and errors. By default concurrency is fixed."
+MAX_RATE_HELP = "Maximal number of rados operations per second. No limit by default."
+CHECK_PROCS_HELP = "Number of processes used to check that files given with -s are sorted, 0 disables the check. " \
+        + "Default is the number of CPUs."
+
+
+def run_profiled(func, profile=None):
+    """
+    Run the function, optionally under cProfile (only the main thread is profiled) or tracemalloc.
+    Profiling results are printed to stderr.
+    """
+    if profile == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            func()
+        finally:
+            profiler.disable()
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    elif profile == 'tracemalloc':
+        tracemalloc.start()
+        try:
+            func()
+        finally:
+            for stat in tracemalloc.take_snapshot().statistics('lineno')[:PROFILE_TOP]:
+                print(stat, file=sys.stderr)
+            tracemalloc.stop()
+    else:
+        func()
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser = argparse.ArgumentParser(epilog="""
@@ -270,10 +691,21 @@ $ search_stub.py search_stub -s -d <( grep ' 2$' really_stub | awk '{print $1}'
 
 As a result you get list of stub files (really stub, where second column is 1, 3 or 4) and dark objects (dark_objects file).
 """, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--stats', help="Write run-time statistics (rados latency histograms, error counts, files/s) to this file as JSON.", default=None)
+    parser.add_argument('--stats_interval', help="Interval between statistics dumps, seconds. Default is {0}.".format(DEF_STATS_INTERVAL),
+            type=float,
+            default=DEF_STATS_INTERVAL
+        )
+    parser.add_argument('--profile', help="Profile the run with cProfile (main thread only) or tracemalloc, results go to stderr.",
+            choices=['cprofile', 'tracemalloc'],
+            default=None
+        )
     subparsers = parser.add_subparsers(dest='subcommand')
     p1 = subparsers.add_parser("search_stub", help="Search for potentially stub files")
     p1.add_argument('-p', '--pool', help="Rados pool to use", required=True)
     p1.add_argument('-n', '--nthreads', help="Number of threads to use. Default is {0}.".format(DEF_NTHREADS), default=DEF_NTHREADS, type=int)
+    p1.add_argument('-m', '--min_nthreads', help=MIN_NTHREADS_HELP, default=None, type=int)
+    p1.add_argument('-r', '--max_rate', help=MAX_RATE_HELP, default=None, type=float)
     p1.add_argument('-N', '--Nprocs', help="Number of processes to use for sort. Default is {0}.".format(DEF_NPROCS), default=DEF_NPROCS, type=int)
     p1.add_argument('-c', '--cleanup', help="Remove temporary files after exit.", action='store_true')
     p1.add_argument('-o', '--object_size', help="Object size. If omitted, it will be requested from each object." \
@@ -281,6 +713,15 @@ As a result you get list of stub files (really stub, where second column is 1, 3
             type=int,
             default=None
         )
+    p1.add_argument('-C', '--cache', help="Sqlite database with the results of previous searches. Files that were fine " \
+            + "and have the same number of objects in the dump will not be checked again. The database is created if missing.",
+            default=None
+        )
+    p1.add_argument('-S', '--sample', help="Fraction of unchanged files that should be checked anyway. Default is 0.",
+            type=float,
+            default=0.0
+        )
+    p1.add_argument('-j', '--check_procs', help=CHECK_PROCS_HELP, type=int, default=os.cpu_count())
     gr = p1.add_mutually_exclusive_group()
     gr.add_argument('-s', '--sorted', help="Indicates that the file with object names is already sorted.", action='store_true')
     gr.add_argument('-t', '--tmpdir', help="Temporary directory to store sorted object dump. Default is {0}".format(DEF_TMPDIR), default=DEF_TMPDIR)
@@ -288,10 +729,14 @@ As a result you get list of stub files (really stub, where second column is 1, 3
 
     p2 = subparsers.add_parser("verify_stub", help="Verify that files are indeed stub")
     p2.add_argument('-p', '--pool', help="Rados pool to use", required=True)
+    p2.add_argument('-n', '--nthreads', help="Number of threads to use. Default is {0}.".format(DEF_NTHREADS), default=DEF_NTHREADS, type=int)
+    p2.add_argument('-m', '--min_nthreads', help=MIN_NTHREADS_HELP, default=None, type=int)
+    p2.add_argument('-r', '--max_rate', help=MAX_RATE_HELP, default=None, type=float)
     p2.add_argument('stub_list', help="List of stub files.")
 
     p3 = subparsers.add_parser("search_dark_objects", help="Print objects of 'very dark' files identified earlier")
     p3.add_argument('-d', '--dark_list', help="List of 'dark' files.")
+    p3.add_argument('-j', '--check_procs', help=CHECK_PROCS_HELP, type=int, default=os.cpu_count())
     gr = p3.add_mutually_exclusive_group()
     gr.add_argument('-s', '--sorted', help="Indicates that the file with object names is already sorted.", action='store_true')
     gr.add_argument('-t', '--tmpdir', help="Temporary directory to store sorted object dump. Default is {0}".format(DEF_TMPDIR), default=DEF_TMPDIR)
@@ -299,29 +744,63 @@ As a result you get list of stub files (really stub, where second column is 1, 3
     return parser.parse_args()
 
 
-if __name__ == '__main__':
-    args = parse_args()
-    if args.subcommand == 'search_stub':
-        if args.sorted:
-            dump = args.obj_dump
-        else:
-            dump = sort_file(args.obj_dump, args.tmpdir)
-
-        if dump is not None:
-            find_stub(dump, args.pool, args.object_size, args.nthreads)
+def find_unsorted(paths, nprocs):
+    """
+    Check that files are sorted in byte order (the order of 'sort' with LC_ALL=C).
 
-        if args.cleanup:
-            if not args.sorted:
-                os.unlink(dump)
+    @return: list of unsorted files
+    """
+    return [path for path in paths if not check_sorted(path, nprocs)['sorted']]
+
+
+def main(args):
+    if getattr(args, 'sorted', False) and args.check_procs > 0:
+        paths = [args.obj_dump] + ([args.dark_list] if args.subcommand == 'search_dark_objects' else [])
+        unsorted = find_unsorted(paths, args.check_procs)
+        if unsorted:
+            print("Files are not sorted: {0}".format(', '.join(unsorted)), file=sys.stderr)
+            sys.exit(1)
+    stats = None
+    if args.stats:
+        stats = Stats(args.stats, args.stats_interval)
+        stats.start()
+    try:
+        if args.subcommand == 'search_stub':
+            if args.sorted:
+                dump = args.obj_dump
             else:
-                print("Will not delete file {0} that was not created by me".format(dump), file=sys.stderr)
-    elif args.subcommand == 'verify_stub':
-        verify_stub(args.stub_list, args.pool)
-    elif args.subcommand == 'search_dark_objects':
-        if args.sorted:
-            obj_dump = args.obj_dump
-            file_dump = args.dark_list
-        else:
-            obj_dump = sort_file(args.obj_dump, args.tmpdir)
-            file_dump = sort_file(args.dark_list, args.tmpdir)
-        find_dark_objects(file_dump, obj_dump)
+                dump = sort_file(args.obj_dump, args.tmpdir)
+
+            if dump is not None:
+                cache = ResultCache(args.cache, args.sample) if args.cache else None
+                try:
+                    find_stub(dump, args.pool, args.object_size, args.nthreads, min_nprocs=args.min_nthreads, max_rate=args.max_rate,
+                            cache=cache, stats=stats)
+                finally:
+                    if cache is not None:
+                        cache.close()
+
+            if args.cleanup:
+                if not args.sorted:
+                    os.unlink(dump)
+                else:
+                    print("Will not delete file {0} that was not created by me".format(dump), file=sys.stderr)
+        elif args.subcommand == 'verify_stub':
+            verify_stub(args.stub_list, args.pool, nprocs=args.nthreads, min_nprocs=args.min_nthreads, max_rate=args.max_rate,
+                    stats=stats)
+        elif args.subcommand == 'search_dark_objects':
+            if args.sorted:
+                obj_dump = args.obj_dump
+                file_dump = args.dark_list
+            else:
+                obj_dump = sort_file(args.obj_dump, args.tmpdir)
+                file_dump = sort_file(args.dark_list, args.tmpdir)
+            find_dark_objects(file_dump, obj_dump)
+    finally:
+        if stats is not None:
+            stats.stop()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    run_profiled(lambda: main(args), args.profile)
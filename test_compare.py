@@ -2,11 +2,16 @@
 import pytest
 import random
 import codecs
+import json
 import sys
 import os
 
+import compare_v2
+import check_sorted
+
 from ast import literal_eval
 from shutil import copyfile
+from types import SimpleNamespace
 from subprocess import call, Popen, PIPE
 
 separator = "|"
@@ -84,7 +89,16 @@ def generate_dumps(tmpdir, base_filename, prefix_num=10, lines=10000, nfiles=3,
             call(["/bin/sed", "-i", f"{row_str}d", filename])
     return res
 
-def test_static():
+@pytest.mark.parametrize(
+        "extra_opts,suffix",
+        [
+            ([], '_sorted'),
+            (['-e', 'auto'], '_sorted'),
+            (['-e', 'memory'], ''),
+            (['-e', 'external'], '_sorted'),
+        ]
+    )
+def test_static(extra_opts, suffix):
     res = 'fsdfadsf\nqwerty\nttttwwwwwww'
     base_filename = TMPDIR + '/gen_dump'
     with open(f'{base_filename}1', 'w') as fd:
@@ -95,17 +109,173 @@ def test_static():
             with open(f'{base_filename}{i}', 'w') as fd:
                 fd.write(data)
         opt = ','.join(f'{base_filename}{i}%%' for i in range(1,4))
-        print(['./compare_v2.py', '-t', TMPDIR, '-d', opt])
-        p = Popen(['./compare_v2.py', '-t', TMPDIR, '-d', opt], stdout=PIPE)
+        print(['./compare_v2.py', '-t', TMPDIR, '-d', opt] + extra_opts)
+        p = Popen(['./compare_v2.py', '-t', TMPDIR, '-d', opt] + extra_opts, stdout=PIPE)
         stdout, stderr = p.communicate()
         if tres != '':
             data = literal_eval(stdout.decode())
             assert [x for x in data.keys()] == [tres]
-            assert [x for x in data.values()] == [ [f'{base_filename}1_sorted'] ]
+            assert [x for x in data.values()] == [ [f'{base_filename}1{suffix}'] ]
         else:
             assert tres == ''
 
 
+@pytest.mark.parametrize("extra_opts", [['-s'], ['-e', 'memory'], ['-e', 'external']])
+def test_manifest(extra_opts):
+    lines = sorted(get_line().split(separator)[0] for _ in range(1000))
+    run_dir = TMPDIR + '/runs'
+    os.makedirs(run_dir, exist_ok=True)
+    runs = []
+    for i in range(3):
+        runs.append(f'run_{i}')
+        with open(f'{run_dir}/run_{i}', 'w') as fd:
+            fd.write(''.join(line + '\n' for line in sorted(lines[i::3])))
+    with open(f'{run_dir}/manifest.json', 'w') as fd:
+        json.dump({'order': 'bytes', 'runs': runs}, fd)
+    full_dump = TMPDIR + '/full_dump'
+    with open(full_dump, 'w') as fd:
+        fd.write(''.join(line + '\n' for line in sorted(lines + ['/zzz', '/aaa'])))
+
+    opt = f'{run_dir}/manifest.json%%,{full_dump}%%'
+    p = Popen(['./compare_v2.py', '-t', TMPDIR, '-d', opt] + extra_opts, stdout=PIPE)
+    stdout, stderr = p.communicate()
+    data = [literal_eval(line) for line in stdout.decode().split('\n') if line]
+    assert data == [{'/aaa': [f'{run_dir}/manifest.json']}, {'/zzz': [f'{run_dir}/manifest.json']}]
+
+
+@pytest.mark.parametrize("dump_type,obj_separator", [('obj', ''), ('obj', '|'), ('objc', '')])
+@pytest.mark.parametrize("extra_opts", [['-s'], ['-e', 'memory'], ['-e', 'external']])
+def test_object_dump(extra_opts, dump_type, obj_separator):
+    names = sorted(set(get_line().split(separator)[0] for _ in range(1000)) | {'/a', '/a-b', '/a.b', '/a/b'})
+    lost = set(random.sample(names, 10))
+    dark = {'/a-c', '/a.', get_line().split(separator)[0]}
+    objects = []
+    counts = {}
+    for name in set(names) - lost | dark:
+        counts[name] = random.randint(1, 5)
+        objects += ['lhcb:{0}.{1:0>16x}'.format(name, i) for i in range(counts[name])]
+    random.shuffle(objects)
+    obj_dump = TMPDIR + '/obj_dump'
+    with open(obj_dump, 'w') as fd:
+        fd.write(''.join(obj + '\n' for obj in (sorted(objects) if '-s' in extra_opts else objects)))
+    file_dump = TMPDIR + '/file_dump'
+    with open(file_dump, 'w') as fd:
+        fd.write(''.join(name + '\n' for name in names))
+
+    opt = f'{obj_dump}%lhcb:%{obj_separator}%{dump_type},{file_dump}%%'
+    p = Popen(['./compare_v2.py', '-t', TMPDIR, '-d', opt] + extra_opts, stdout=PIPE)
+    stdout, stderr = p.communicate()
+    missing = {}
+    found_counts = {}
+    for line in stdout.decode().split('\n'):
+        if line:
+            res = literal_eval(line)
+            objects = res.pop('objects', {})
+            for k, v in res.items():
+                missing[k] = [os.path.basename(x).replace('_sorted', '') for x in v]
+                if objects:
+                    assert [os.path.basename(x).replace('_sorted', '') for x in objects] == ['obj_dump']
+                    found_counts[k] = list(objects.values())[0]
+    assert missing == {**{name: ['obj_dump'] for name in lost}, **{name: ['file_dump'] for name in dark}}
+    assert found_counts == ({name: counts[name] for name in dark} if dump_type == 'objc' else {})
+
+
+def test_front_coded_keys():
+    keys = sorted(set(get_line().split(separator)[0].encode() for _ in range(1000)) | {b'', b'/a', b'/a/b', b'/\xc3\xa9' * 100})
+    fck = compare_v2.FrontCodedKeys(keys)
+    assert list(fck) == keys
+    lfns = sorted(f'/lhcb/MC/2012/ALLSTREAMS.DST/{i // 100:08d}/0000/{i // 100:08d}_{i:08d}_1.allstreams.dst'.encode() for i in range(1000))
+    assert len(compare_v2.FrontCodedKeys(lfns).data) * 3 < sum(len(k) for k in lfns)
+    fd = compare_v2.KeyRuns([fck]).open()
+    assert [fd.readline() for _ in range(len(keys) + 1)] == [k.decode() + '\n' for k in keys] + ['']
+    for a, b in [(b'', b'/a'), (b'/a', b'/a'), (b'/a', b'/a\0b'), (b'/a/b', b'/a-b'), (b'/ab\0', b'/ab\x01'), (b'x' * 300, b'x' * 299 + b'y')]:
+        expected = len(os.path.commonprefix([a, b]))
+        assert compare_v2.common_prefix_len(a, b) == compare_v2.common_prefix_len(b, a) == expected
+
+
+def test_choose_engine(monkeypatch):
+    path = TMPDIR + '/engine_dump'
+    with open(path, 'w') as fd:
+        fd.write('x' * 1000)
+
+    monkeypatch.setattr(compare_v2, 'disk_usage', lambda path: SimpleNamespace(free=10 ** 9))
+    assert compare_v2.choose_engine([path], TMPDIR + '/missing/dir') == 'external'
+    monkeypatch.setattr(compare_v2, 'disk_usage', lambda path: SimpleNamespace(free=1500))
+    assert compare_v2.choose_engine([path], TMPDIR) == 'memory'
+    assert compare_v2.choose_engine([path], TMPDIR, ncpus='2') == 'external'
+    monkeypatch.setattr(compare_v2, 'MEMORY_FACTOR', 2 * 1024 * 1024)
+    assert compare_v2.choose_engine([path], TMPDIR, memory_budget=1) == 'external'
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100000])
+def test_load_keys(chunk_size):
+    names = [get_line().split(separator)[0] for _ in range(100)] + ['/a', '/a-b', '/a.b']
+    lines = [name + separator + str(i) for name in names for i in range(names.index(name) % 3 + 1)]
+    random.shuffle(lines)
+    path = TMPDIR + '/load_dump'
+    with open(path, 'w') as fd:
+        fd.write(''.join(line + '\n' for line in lines))
+    keys = compare_v2.load_keys(path, '', separator, chunk_size=chunk_size)
+    assert list(keys) == sorted(name.encode() for name in set(names))
+
+    with open(path, 'w') as fd:
+        fd.write(''.join('lhcb:{0}.{1:0>16x}\n'.format(line.split(separator)[0], int(line.split(separator)[1])) for line in lines))
+    keys = compare_v2.load_keys(path, 'lhcb:', separator, 'objc', chunk_size=chunk_size)
+    assert list(keys) == [f'{name}{separator}{names.index(name) % 3 + 1}'.encode() for name in sorted(set(names), key=str.encode)]
+
+
+@pytest.mark.parametrize("extra_opts", [['-s'], ['-e', 'memory'], ['-e', 'external']])
+def test_duplicates(extra_opts):
+    dumps = {'dupA': ['/a|1', '/a|2', '/b|1', '/c|1'], 'dupB': ['/a|1', '/b|1', '/b|2']}
+    for name, lines in dumps.items():
+        with open(f'{TMPDIR}/{name}', 'w') as fd:
+            fd.write(''.join(line + '\n' for line in lines))
+    opt = ','.join(f'{TMPDIR}/{name}' for name in dumps)
+    p = Popen(['./compare_v2.py', '-t', TMPDIR, '-d', opt] + extra_opts, stdout=PIPE)
+    stdout, stderr = p.communicate()
+    data = [literal_eval(line) for line in stdout.decode().split('\n') if line]
+    assert [{k: [os.path.basename(x).replace('_sorted', '') for x in v]} for res in data for k, v in res.items()] == [{'/c': ['dupB']}]
+
+
+@pytest.mark.parametrize("nprocs", [1, 4])
+def test_check_sorted(nprocs):
+    lines = sorted(set(get_line() for _ in range(10000)), key=lambda x: x.split(separator)[0].encode())
+    path = TMPDIR + '/check_dump'
+    with open(path, 'w') as fd:
+        fd.write(''.join(line + '\n' for line in lines))
+    res = check_sorted.check_sorted(path, nprocs, separator, nsplits=8)
+    assert res['sorted']
+    assert len(res['splits']) == 8
+    assert len(check_sorted.check_sorted(path, 8, separator, nsplits=3)['splits']) == 3
+    assert len(check_sorted.check_sorted(path, nprocs, separator)['splits']) == nprocs
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    for offset, key in res['splits']:
+        assert offset == 0 or data[offset - 1:offset] == b'\n'
+        assert data[offset:].startswith(key.encode() + separator.encode())
+
+    for idx in (0, len(lines) // 8, len(lines) // 2, len(lines) - 2):
+        spoiled = lines[:idx] + [lines[idx + 1], lines[idx]] + lines[idx + 2:]
+        with open(path, 'w') as fd:
+            fd.write(''.join(line + '\n' for line in spoiled))
+        res = check_sorted.check_sorted(path, nprocs, separator, nsplits=8)
+        assert not res['sorted']
+        assert res['error_offset'] == sum(len(line.encode()) + 1 for line in spoiled[:idx + 1])
+
+
+def test_unsorted_input():
+    path = TMPDIR + '/unsorted_dump'
+    with open(path, 'w') as fd:
+        fd.write('/b\n/a\n/c\n')
+    p = Popen(['./compare_v2.py', '-t', TMPDIR, '-s', '-d', f'{path}%%,{path}%%'], stdout=PIPE, stderr=PIPE)
+    stdout, stderr = p.communicate()
+    assert p.returncode == 1
+    assert stdout == b''
+    p = Popen(['./compare_v2.py', '-t', TMPDIR, '-d', f'{path}%%,{path}%%'], stdout=PIPE, stderr=PIPE)
+    stdout, stderr = p.communicate()
+    assert p.returncode == 0
+
+
 @pytest.mark.parametrize(
         "prefixes,n_files,lines",
         [
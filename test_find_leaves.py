@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+import io
+import json
+import pytest
+
+pytest.importorskip('DIRAC')
+
+import find_leaves
+
+
+class FakeFileCatalog:
+    """
+    FileCatalog stand-in built from a dict {<directory>: ([<subdirs>], [<files>])}.
+    """
+    def __init__(self, tree):
+        self.tree = tree
+
+    def listDirectory(self, directory, verbose):
+        if directory not in self.tree:
+            return {'OK': False, 'Message': 'No such directory'}
+        dirs, files = self.tree[directory]
+        return {'OK': True, 'Value': {'Successful': {
+            directory: {'SubDirs': {d: True for d in dirs}, 'Files': {f: True for f in files}}
+        }, 'Failed': {}}}
+
+
+class ListWriter:
+    "OutputWriter stand-in collecting LFNs into a list."
+    def __init__(self):
+        self.lfns = []
+
+    def write(self, lfns):
+        self.lfns += lfns
+
+
+def make_tree(width, levels, root='/lhcb'):
+    tree = {}
+    todo = [(root, levels)]
+    while todo:
+        directory, level = todo.pop()
+        dirs = [f'{directory}/d{i}' for i in range(width)] if level > 0 else []
+        tree[directory] = (dirs, [f'{directory}/f{i}' for i in range(2)])
+        todo += [(d, level - 1) for d in dirs]
+    return tree
+
+
+@pytest.mark.parametrize("nthreads", [1, 4])
+def test_walk_tree(monkeypatch, nthreads):
+    tree = make_tree(3, 3)
+    searched = []
+
+    def fake_find(directory, fc, se, writer):
+        searched.append(directory)
+        return []
+
+    monkeypatch.setattr(find_leaves, 'findFiles', fake_find)
+    failed, files = find_leaves.walkTree('/lhcb', FakeFileCatalog(tree), 'SE', ListWriter(), 2, nthreads,
+            exclude=['/lhcb/d0'])
+    assert failed == []
+    assert sorted(searched) == sorted(d for d in tree if d.count('/') == 3 and not d.startswith('/lhcb/d0/'))
+    assert sorted(files) == sorted(f for d in tree if d.count('/') < 3 and d != '/lhcb/d0' for f in tree[d][1])
+
+
+def test_walk_tree_split(monkeypatch):
+    tree = make_tree(2, 3)
+    searched = []
+
+    def fake_find(directory, fc, se, writer):
+        searched.append(directory)
+        return [] if directory.count('/') > 3 else None
+
+    monkeypatch.setattr(find_leaves, 'findFiles', fake_find)
+    failed, files = find_leaves.walkTree('/lhcb', FakeFileCatalog(tree), 'SE', ListWriter(), 1, 3, attempts=1)
+    assert sorted(failed) == sorted(d for d in tree if d.count('/') == 3)
+    assert [d for d in searched if d.count('/') > 3] == []
+
+    searched.clear()
+    failed, files = find_leaves.walkTree('/lhcb', FakeFileCatalog(tree), 'SE', ListWriter(), 1, 3, attempts=3)
+    assert failed == []
+    assert sorted(d for d in searched if d.count('/') > 3) == sorted(d for d in tree if d.count('/') == 4)
+
+
+def test_snapshot(monkeypatch, tmp_path):
+    noSize = set()
+    broken = set()
+
+    class SizeCatalog(FakeFileCatalog):
+        def listDirectory(self, directory, verbose):
+            if directory in broken:
+                return {'OK': False, 'Message': 'Timeout'}
+            return super().listDirectory(directory, verbose)
+
+        def getDirectorySize(self, directory, longOutput):
+            if directory in noSize:
+                return {'OK': False, 'Message': 'Timeout'}
+            files = [f for d in self.tree if d == directory or d.startswith(directory + '/') for f in self.tree[d][1]]
+            return {'OK': True, 'Value': {'Successful': {directory: {
+                'LogicalFiles': len(files), 'PhysicalSize': {'SE': {'Files': len(files), 'Size': 10 * len(files)}}
+            }}, 'Failed': {}}}
+
+    tree = make_tree(3, 3)
+    searched = []
+
+    def fake_find(directory, fc, se, writer):
+        searched.append(directory)
+        if directory in broken:
+            return None
+        lfns = [f for d in fc.tree if d == directory or d.startswith(directory + '/') for f in fc.tree[d][1]]
+        writer.write(lfns)
+        return lfns
+
+    def run(exclude=None):
+        searched.clear()
+        writer = ListWriter()
+        snapshot = find_leaves.DirectorySnapshot(str(tmp_path / 'snapshot'), 'SE', '/lhcb', exclude)
+        failed, files = find_leaves.walkTree('/lhcb', SizeCatalog(tree), 'SE', writer, 2, 2, exclude=exclude, snapshot=snapshot)
+        snapshot.close(failed)
+        assert failed == sorted(broken)
+        skipped = list(broken) + (exclude or [])
+        assert sorted(writer.lfns + files) == sorted(f for d in tree if not any(d == b or d.startswith(b + '/') for b in skipped)
+                                                     for f in tree[d][1])
+        return searched[:]
+
+    monkeypatch.setattr(find_leaves, 'findFiles', fake_find)
+    # Reused LFNs are passed to the writer in several blocks
+    monkeypatch.setattr(find_leaves, 'BLOCK_SIZE', 4)
+    assert len(run()) == 9
+    assert run() == []
+    tree['/lhcb/d1/d2/d0'][1].append('/lhcb/d1/d2/d0/new')
+    assert run() == ['/lhcb/d1/d2']
+    del tree['/lhcb/d2/d1/d0']
+    del tree['/lhcb/d2/d1/d1']
+    del tree['/lhcb/d2/d1/d2']
+    del tree['/lhcb/d2/d1']
+    tree['/lhcb/d2'][0].remove('/lhcb/d2/d1')
+    assert run() == []
+    assert run() == []
+
+    # Partially failed run must not make the stale data of its parents look up to date
+    noSize.update(['/lhcb', '/lhcb/d0', '/lhcb/d0/d0'])
+    broken.add('/lhcb/d0/d0')
+    assert run() == ['/lhcb/d0/d0']
+    noSize.clear()
+    broken.clear()
+    assert run() == ['/lhcb/d0/d0']
+    assert run() == []
+
+    # Snapshot made with another exclude list is not used
+    leaves = sorted(d for d in tree if d.count('/') == 3)
+    assert sorted(run(exclude=['/lhcb/d0'])) == [d for d in leaves if not d.startswith('/lhcb/d0/')]
+    assert run(exclude=['/lhcb/d0']) == []
+    assert sorted(run()) == leaves
+    assert run() == []
+
+
+@pytest.mark.parametrize("nthreads", [1, 3])
+def test_resolve_replicas(nthreads):
+    class ReplicaCatalog:
+        def __init__(self):
+            self.calls = 0
+
+        def getReplicas(self, lfns):
+            self.calls += 1
+            if '/lhcb/bad' in lfns:
+                return {'OK': False, 'Message': 'Timeout'}
+            return {'OK': True, 'Value': {'Successful': {lfn: {'SE' if int(lfn[-1]) % 2 else 'OTHER': lfn} for lfn in lfns}, 'Failed': {}}}
+
+    files = [f'/lhcb/f{i}' for i in range(10)]
+    fc = ReplicaCatalog()
+    writer = ListWriter()
+    failed = find_leaves.resolveReplicas(files[:5] + ['/lhcb/bad'] + files[5:], fc, 'SE', writer, nthreads,
+            chunkSize=3, attempts=2)
+    assert sorted(failed) == ['/lhcb/bad', '/lhcb/f3', '/lhcb/f4']
+    assert fc.calls == 5
+    assert sorted(writer.lfns) == ['/lhcb/f1', '/lhcb/f5', '/lhcb/f7', '/lhcb/f9']
+
+
+def test_meta_query_cache(monkeypatch):
+    class FakeMetaQuery:
+        def __init__(self, typeDict):
+            self.typeDict = typeDict
+
+        def setMetaQuery(self, queryList):
+            query = dict(x.split('=') for x in queryList)
+            assert all(k in self.typeDict for k in query)
+            return {'OK': True, 'Value': query}
+
+    class MetaCatalog(FakeFileCatalog):
+        def __init__(self, tree):
+            super().__init__(tree)
+            self.schemaCalls = 0
+            self.queries = []
+
+        def getMetadataFields(self):
+            self.schemaCalls += 1
+            return {'OK': True, 'Value': {'FileMetaFields': {}, 'DirectoryMetaFields': {}}}
+
+        def findFilesByMetadata(self, metaDict, path):
+            self.queries.append((metaDict, path))
+            return {'OK': True, 'Value': [path + '/file']}
+
+    monkeypatch.setattr(find_leaves, 'MetaQuery', FakeMetaQuery, raising=False)
+    monkeypatch.setattr(find_leaves, 'FILE_STANDARD_METAKEYS', {'SE': 'VARCHAR'}, raising=False)
+    monkeypatch.setattr(find_leaves, 'metaQueryCache', {})
+    fc = MetaCatalog({'/lhcb': ([f'/lhcb/d{i}' for i in range(20)], [])})
+    writer = ListWriter()
+    failed, files = find_leaves.walkTree('/lhcb', fc, 'SE', writer, 1, 4)
+    assert failed == []
+    assert sorted(writer.lfns) == sorted(f'/lhcb/d{i}/file' for i in range(20))
+    assert fc.schemaCalls == 1
+    assert sorted(path for _, path in fc.queries) == sorted(f'/lhcb/d{i}' for i in range(20))
+    assert all(metaDict == {'SE': 'SE'} for metaDict, _ in fc.queries)
+    find_leaves.getMetaQuery(fc, 'SE', refresh=True)
+    assert fc.schemaCalls == 2
+
+
+def test_output_writer(tmp_path):
+    lfns = [f'/lhcb/{x}' for x in ('b', 'a-b', 'a', 'é', 'c/d', 'ab', 'a/b')]
+    writer = find_leaves.OutputWriter(str(tmp_path), runSize=3)
+    writer.start()
+    for lfn in lfns:
+        writer.write([lfn])
+    writer.close()
+    with open(tmp_path / 'manifest.json') as fd:
+        manifest = json.load(fd)
+    assert manifest['runs'] == ['run_000000', 'run_000001', 'run_000002']
+    found = []
+    for run in manifest['runs']:
+        with open(tmp_path / run, 'rb') as fd:
+            lines = fd.read().split(b'\n')[:-1]
+        assert lines == sorted(lines)
+        found += lines
+    assert sorted(found) == sorted(lfn.encode() for lfn in lfns)
+
+    out = io.StringIO()
+    writer = find_leaves.OutputWriter(blockSize=2, out=out)
+    writer.start()
+    writer.write(lfns)
+    writer.close()
+    assert out.getvalue() == ''.join(lfn + '\n' for lfn in lfns)
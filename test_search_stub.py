@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+import sys
+import json
+import time
+import pytest
+
+rados = pytest.importorskip('rados')
+
+import search_stub
+
+
+def test_stats_at_exit(monkeypatch, tmp_path):
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt()
+
+    stats_path = str(tmp_path / 'stats.json')
+    monkeypatch.setattr(search_stub, 'verify_stub', interrupted)
+    monkeypatch.setattr(sys, 'argv', ['search_stub.py', '--stats', stats_path, 'verify_stub', '-p', 'pool', 'stubs'])
+    with pytest.raises(KeyboardInterrupt):
+        search_stub.main(search_stub.parse_args())
+    with open(stats_path) as fd:
+        assert 'counters' in json.load(fd)
+
+
+def run_window(limiter, latency, failed=False):
+    "Run one window of operations with the given latency."
+    starts = [limiter.acquire() for _ in range(limiter.limit)]
+    for start in starts:
+        limiter.release(start - latency, failed)
+
+
+class FakeIoctx:
+    def __init__(self, error=None):
+        self.error = error
+
+    def stat(self, key):
+        if self.error is not None:
+            raise self.error
+        return (4, None)
+
+
+def test_limiter_growth():
+    limiter = search_stub.AdaptiveLimiter(2, 6)
+    limits = []
+    for _ in range(6):
+        run_window(limiter, 0.01)
+        limits.append(limiter.limit)
+    assert limits == [3, 4, 5, 6, 6, 6]
+    run_window(limiter, 0.05)
+    assert limiter.limit == 3
+
+
+def test_limiter_errors():
+    limiter = search_stub.AdaptiveLimiter(1, 8)
+    for _ in range(7):
+        run_window(limiter, 0.01)
+    assert limiter.limit == 8
+
+    ctx = search_stub.LimitedIoctx(FakeIoctx(rados.ObjectNotFound('missing')), limiter)
+    for _ in range(8):
+        with pytest.raises(rados.ObjectNotFound):
+            ctx.stat('obj')
+    assert limiter.limit == 8
+
+    ctx = search_stub.LimitedIoctx(FakeIoctx(rados.Error('timeout')), limiter)
+    for _ in range(8):
+        with pytest.raises(rados.Error):
+            ctx.stat('obj')
+    assert limiter.limit == 4
+    assert limiter.inflight == 0
+
+
+def test_limiter_baseline_decay():
+    limiter = search_stub.AdaptiveLimiter(1, 10)
+    for _ in range(3):
+        run_window(limiter, 0.01)
+    # Burst of very fast operations, then a lasting shift of latency
+    run_window(limiter, 0.0001)
+    limits = []
+    for _ in range(20):
+        run_window(limiter, 0.03)
+        limits.append(limiter.limit)
+    assert limits[-1] == 10
+
+
+def test_limiter_max_rate():
+    limiter = search_stub.AdaptiveLimiter(4, 4, max_rate=50)
+    start = time.monotonic()
+    for _ in range(21):
+        limiter.release(limiter.acquire())
+    assert time.monotonic() - start >= 0.39
+
+
+class FakePool:
+    """
+    Rados ioctx stand-in built from a dict {<file name>: (<striper.size>, [<object sizes>])}.
+    Names of the checked files are collected in checked.
+    """
+    OBJECT_SIZE = 10
+
+    def __init__(self, files):
+        self.files = files
+        self.checked = []
+
+    def get_xattr(self, key, xattr_name):
+        name = key[:-17]
+        if xattr_name == 'striper.size':
+            self.checked.append(name)
+            return str(self.files[name][0]).encode()
+        return str(self.OBJECT_SIZE).encode()
+
+    def stat(self, key):
+        name, idx = key[:-17], int(key[-16:], 16)
+        return (self.files[name][1][idx], None)
+
+    def close(self):
+        pass
+
+    def dump(self, path):
+        with open(path, 'w') as fd:
+            for name in sorted(self.files):
+                for idx in range(len(self.files[name][1])):
+                    fd.write(search_stub.filename2object(name, idx) + '\n')
+
+
+@pytest.mark.parametrize("nprocs", [1, 3])
+def test_result_cache(monkeypatch, tmp_path, capsys, nprocs):
+    pool = FakePool({'/a': (15, [10, 5]), '/b': (7, [7]), '/stub': (30, [10, 5]), '/z': (1, [1])})
+    monkeypatch.setattr(search_stub, 'open_limited_ioctx', lambda *args, **kwargs: pool)
+    dump = str(tmp_path / 'dump')
+    cache_path = str(tmp_path / 'cache')
+
+    def run(sample=0.0):
+        pool.checked = []
+        pool.dump(dump)
+        cache = search_stub.ResultCache(cache_path, sample)
+        search_stub.find_stub(dump, 'pool', nprocs=nprocs, cache=cache)
+        cache.close()
+        assert capsys.readouterr().out.split() == ['/stub']
+        return sorted(pool.checked)
+
+    assert run() == ['/a', '/b', '/stub', '/z']
+    # Stub verdicts are never taken from the cache
+    assert run() == ['/stub']
+    pool.files['/b'] = (17, [10, 7])
+    assert run() == ['/b', '/stub']
+    assert run(sample=1.0) == ['/a', '/b', '/stub', '/z']
+    assert run() == ['/stub']
+
+
+def test_result_cache_interrupted(monkeypatch, tmp_path):
+    pool = FakePool({'/a': (15, [10, 5]), '/b': (7, [7]), '/stub': (30, [10, 5])})
+    dump = str(tmp_path / 'dump')
+    cache_path = str(tmp_path / 'cache')
+    pool.dump(dump)
+
+    def interrupted(*args, **kwargs):
+        cache = kwargs['cache']
+        cache.store('/a', 2, True, 15, 5)
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(search_stub, 'find_stub', interrupted)
+    monkeypatch.setattr(sys, 'argv', ['search_stub.py', 'search_stub', '-p', 'pool', '-s', '-j', '0', '-C', cache_path, dump])
+    with pytest.raises(KeyboardInterrupt):
+        search_stub.main(search_stub.parse_args())
+    cache = search_stub.ResultCache(cache_path)
+    assert cache.is_unchanged('/a', 2)
+    cache.close()